@@ -7,3 +7,26 @@ SECRET_KEY = 'vRjCtZZvxeJnSLIBQNEtXkIbDABLtFVVWXElPJ'
 SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(
     os.path.join(ROOT_PATH, 'OperationalPerformance.db'))
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+ACTION_SNAPSHOT_PATH = os.path.join(ROOT_PATH, 'action.snapshot')
+# 巡检时复用按设备缓存的SSH会话
+SSH_POOL = False
+# 连续的show类命令一次性发送, 不逐条等待提示符
+SSH_PIPELINE = False
+# 设备信息库(CMDB)
+DEVICE_DB = {
+    'user': 'root',
+    'password': '',
+    'host': '127.0.0.1',
+    'database': 'cmdb',
+    'port': 3306,
+}
+# 设备清单缓存增量同步的间隔秒数
+DEVICE_INVENTORY_INTERVAL = 60
+# 巡检记录按月分区存储: MySQL使用原生RANGE分区, SQLite每月一张表
+INSPECTION_PARTITION = False
+# 巡检记录保留天数, 更早的只保留每日汇总
+INSPECTION_RETENTION_DAYS = 180
+# 超过该天数的巡检记录每台设备每个动作每天只保留最后一条, 为0时不降采样
+INSPECTION_DOWNSAMPLE_DAYS = 30
+# 解析结果缓存保留天数
+INSPECTION_PARSE_CACHE_DAYS = 30
@@ -7,6 +7,7 @@ from .default import *  # NOQA F401
 TEST_BASE_DIR = os.path.join(ROOT_PATH, '.test')
 SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(
     os.path.join(TEST_BASE_DIR, 'OperationalPerformance.db'))
+ACTION_SNAPSHOT_PATH = os.path.join(TEST_BASE_DIR, 'action.snapshot')
 # SQLALCHEMY_ECHO = True
 TESTING = True
 
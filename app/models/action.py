@@ -39,20 +39,8 @@ class Devices(db.Model):
 
     @classmethod
     def to_model(cls, **kwargs):
-        return to_model(**kwargs)
+        return to_model(cls, **kwargs)
 
     def to_dict(self):
-        res = {}
-        for col in self.__table__.columns:
-            val = getattr(self, col.name)
-            if isinstance(col.type, DateTime):  # 判断类型是否为DateTime
-                if not val:  # 判断实例中该字段是否有值
-                    value = ""
-                else:  # 进行格式转换
-                    value = val.strftime("%Y-%m-%d %H:%M:%S")
-            elif isinstance(col.type, Numeric):  # 判断类型是否为Numeric
-                value = float(val)  # 进行格式转换
-            else:  # 剩余的直接取值
-                value = val
-            res[col.name] = value
-        return res
+        # DateTime转为字符串, Numeric转为float, 转换函数按列预先生成
+        return to_dict(self)
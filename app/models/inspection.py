@@ -0,0 +1,66 @@
+from typing import Dict
+
+from sqlalchemy import func
+
+from app.exts import db
+from app.utils.mode_dict import to_model, to_dict
+
+
+class Inspection(db.Model):
+    __tablename__ = "inspection"
+    __table_args__ = (
+        # 按时间范围导出, 按设备统计最近的巡检耗时
+        db.Index("ix_inspection_timestamp_sn", "timestamp", "sn"),
+        db.Index("ix_inspection_sn_timestamp", "sn", "timestamp"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    sn = db.Column(db.String(128), nullable=False, comment="资产号")
+    action_id = db.Column(db.Integer, comment="动作id")
+    output = db.Column(db.Text, comment="回显, 新数据只保存output_hash")
+    output_hash = db.Column(db.String(64), index=True, comment="回显内容的sha256, 对应inspection_output")
+    parse_result = db.Column(db.Text, comment="解析结果")
+    validation_result = db.Column(db.Text, comment="校验结果")
+    duration = db.Column(db.Float, comment="设备巡检耗时(秒)")
+    timestamp = db.Column(db.DateTime(), nullable=False, server_default=func.now(), comment="巡检时间")
+
+    @classmethod
+    def to_model(cls, **kwargs) -> db.Model:
+        return to_model(cls, **kwargs)
+
+    def to_dict(self) -> Dict:
+        return to_dict(self)
+
+
+class InspectionOutput(db.Model):
+    __tablename__ = "inspection_output"
+    hash = db.Column(db.String(64), primary_key=True, comment="回显内容的sha256")
+    codec = db.Column(db.String(8), nullable=False, comment="压缩方式[zlib|zstd]")
+    size = db.Column(db.Integer, nullable=False, comment="原始字节数")
+    data = db.Column(db.LargeBinary, nullable=False, comment="压缩后的回显")
+    created_at = db.Column(db.DateTime(), nullable=False, server_default=func.now(), index=True,
+                           comment="写入时间, 复用已有回显时刷新, 清理无引用的回显时跳过宽限期内的")
+
+
+class InspectionParseCache(db.Model):
+    __tablename__ = "inspection_parse_cache"
+    action_id = db.Column(db.Integer, primary_key=True, autoincrement=False, comment="动作id")
+    parse_digest = db.Column(db.String(40), primary_key=True, comment="解析类型及内容的sha1")
+    output_hash = db.Column(db.String(64), primary_key=True, comment="回显内容的sha256")
+    parse_result = db.Column(db.Text, comment="解析结果")
+    validation_result = db.Column(db.Text, comment="校验结果")
+    updated_at = db.Column(db.DateTime(), nullable=False, server_default=func.now(), comment="写入时间")
+
+
+class InspectionRollup(db.Model):
+    __tablename__ = "inspection_rollup"
+    day = db.Column(db.Date, primary_key=True, comment="巡检日期")
+    idc = db.Column(db.String(64), primary_key=True, comment="机房")
+    vendor = db.Column(db.String(64), primary_key=True, comment="厂商")
+    action_id = db.Column(db.Integer, primary_key=True, autoincrement=False, comment="动作id")
+    metric = db.Column(db.String(128), primary_key=True, comment="校验字段, *表示整条校验结果")
+    pass_count = db.Column(db.Integer, nullable=False, default=0, comment="通过次数")
+    fail_count = db.Column(db.Integer, nullable=False, default=0, comment="失败次数")
+    value_count = db.Column(db.Integer, nullable=False, default=0, comment="数值个数")
+    value_sum = db.Column(db.Float, nullable=False, default=0, comment="数值之和, 平均值为value_sum/value_count")
+    value_min = db.Column(db.Float, comment="最小值")
+    value_max = db.Column(db.Float, comment="最大值")
@@ -1,6 +1,7 @@
 import importlib
 import logging
 
+import click
 from flask import Flask, request
 from flask.helpers import get_env
 
@@ -29,8 +30,90 @@ def register_error_handler(app):
     app.register_error_handler(Exception, ErrHandler.handler)
 
 
+def warm_caches(app):
+    """ Precompute cached responses that do not depend on the database.
+    """
+    from app.services import OptionService
+    from app.services.response_cache import OPTIONS, response_cache
+    response_cache.get(OPTIONS, None, OptionService.dumps)
+
+
 def register_cmds(app):
-    pass
+    @app.cli.command('publish-action-snapshot')
+    def publish_action_snapshot():
+        """ Compile action catalog into the snapshot shared by workers.
+        """
+        from app.services import ActionORMHandler
+        generation = ActionORMHandler(
+            db.session(), app.config['ACTION_SNAPSHOT_PATH']).publish_snapshot()
+        click.echo(f'published action snapshot generation {generation}')
+
+    @app.cli.command('import-devices')
+    @click.argument('source', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+    @click.option('--batch-size', default=1000, show_default=True)
+    def import_devices(source, fmt, batch_size):
+        """ Upsert devices into the CMDB from a CSV or NDJSON file ('-' for stdin).
+        """
+        from app.services import DeviceDBHandler, iter_csv, iter_ndjson
+
+        def progress(chunk):
+            if chunk['error']:
+                click.echo(f"chunk {chunk['chunk']} rows {chunk['start']}-{chunk['start'] + chunk['count'] - 1} "
+                           f"failed: {chunk['error']}", err=True)
+            else:
+                click.echo(f"imported {chunk['imported']} rows")
+
+        handler = DeviceDBHandler(**app.config['DEVICE_DB'])
+        try:
+            rows = iter_csv(source) if fmt == 'csv' else iter_ndjson(source)
+            report = handler.import_rows(rows, batch_size=batch_size, progress=progress)
+        finally:
+            handler.close_db()
+        click.echo(f"total {report['total']}, imported {report['imported']}, failed {report['failed']}")
+
+    @app.cli.command('rebuild-inspection-rollup')
+    @click.argument('start', type=click.DateTime(formats=['%Y-%m-%d']))
+    @click.argument('end', type=click.DateTime(formats=['%Y-%m-%d']))
+    def rebuild_inspection_rollup(start, end):
+        """ Recompute the daily inspection rollup for START..END (inclusive) from raw rows.
+        """
+        from app.services import DeviceDBHandler, InspectionORMHandler
+        handler = DeviceDBHandler(**app.config['DEVICE_DB'])
+        try:
+            InspectionORMHandler(db.session()).rebuild_rollup(handler, start.date(), end.date())
+        finally:
+            handler.close_db()
+        click.echo(f'rebuilt inspection rollup {start:%Y-%m-%d}..{end:%Y-%m-%d}')
+
+    @app.cli.command('export-inspection-columnar')
+    @click.argument('start', type=click.DateTime(formats=['%Y-%m-%d', '%Y-%m-%d %H:%M:%S']))
+    @click.argument('end', type=click.DateTime(formats=['%Y-%m-%d', '%Y-%m-%d %H:%M:%S']))
+    @click.option('--directory', default=None, help='Output directory, defaults to export_<time>.')
+    @click.option('--part-rows', default=100000, show_default=True)
+    def export_inspection_columnar(start, end, directory, part_rows):
+        """ Export inspection results between START and END as day-partitioned columnar files.
+        """
+        from app.services import DeviceDBHandler, InspectionORMHandler
+        handler = DeviceDBHandler(**app.config['DEVICE_DB'])
+        try:
+            files = InspectionORMHandler(db.session()).export_columnar(
+                handler, start, end, directory=directory, part_rows=part_rows)
+        finally:
+            handler.close_db()
+        click.echo(f'exported {len(files)} files')
+        for path in files:
+            click.echo(path)
+
+    @app.cli.command('inspection-maintenance')
+    def inspection_maintenance():
+        """ Create upcoming partitions, downsample and expire old inspection rows.
+        """
+        from app.services import InspectionORMHandler
+        result = InspectionORMHandler(db.session()).maintain(
+            app.config['INSPECTION_RETENTION_DAYS'], app.config.get('INSPECTION_DOWNSAMPLE_DAYS', 0),
+            parse_cache_days=app.config.get('INSPECTION_PARSE_CACHE_DAYS', 30))
+        click.echo(f'inspection maintenance: {result}')
 
 
 def create_app():
@@ -42,6 +125,7 @@ def create_app():
         register_blueprints(app)
     register_error_handler(app)
     register_cmds(app)
+    warm_caches(app)
 
     @app.before_request
     def log_request_info():
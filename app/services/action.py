@@ -1,5 +1,18 @@
 import abc
-from typing import List, Dict, Optional
+import contextlib
+import fcntl
+import json
+import os
+import threading
+from typing import Any, Iterator, List, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam
+
+from app.services.parser import parser_cache
+from app.services.response_cache import ACTIONS, response_cache
+from app.utils.mode_dict import bulk_insert, to_models
+from app.utils.serializer import serializer_for
+from app.utils.snapshot import ActionSnapshot, publish_snapshot, snapshot_lock
 
 
 class ActionHandler(abc.ABC):
@@ -24,26 +37,306 @@ class ActionHandler(abc.ABC):
         pass
 
 
+def _write_atomic(path: str, lines: List[str]) -> None:
+    """
+    先写临时文件再rename, 写到一半崩溃也不会截断原文件
+    :param path: 目标文件路径
+    :param lines: List[str] 写入的内容
+    """
+    tmp = "%s.tmp" % path
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
 class ActionJSONHandler(ActionHandler):
-    def __init__(self, location: str) -> None:
+    # 建立二级索引的字段, 按这些字段筛选时直接查字典而不是全量扫描
+    index_fields = ("vendor", "model", "name", "cmd")
+
+    def __init__(self, location: str, journal: bool = False, compact_threshold: int = 1000,
+                 background_compact: bool = True) -> None:
         """
         :param location: 文件的路径
+        :param journal: 是否启用追加写日志, 启用后add/delete只追加一条记录到 <location>.journal
+        :param compact_threshold: 日志记录数达到该值时合并回主文件
+        :param background_compact: 是否在后台线程中合并
+        多个进程(如gunicorn的多个worker)共用同一个文件时, 写入和合并通过 <location>.lock 的文件锁互斥
         """
-        import os
         if not os.path.exists(location):
             raise Exception("%s path has no exists" % location)
         self.path = location
+        self.journal = journal
+        self.journal_path = "%s.journal" % location
+        self.lock_path = "%s.lock" % location
+        self.compact_threshold = compact_threshold
+        self.background_compact = background_compact
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._signature: Optional[Tuple] = None
+        self._items: List[Dict] = []
+        self._indexes: Dict[str, Dict[Any, List[int]]] = {}
+        self._journal_records = 0
+        # 本进程持有文件锁的嵌套层数, 只在self._lock内访问
+        self._flock_depth = 0
+
+    @contextlib.contextmanager
+    def _flock(self, shared: bool = False):
+        """
+        进程间的文件锁, 同时持有线程锁. 同一线程内可以嵌套, 嵌套时沿用最外层的锁
+        :param shared: 是否为共享锁(只读)
+        """
+        with self._lock:
+            if self._flock_depth:
+                self._flock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._flock_depth -= 1
+                return
+            with open(self.lock_path, "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                self._flock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._flock_depth = 0
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _file_stat(path: str) -> Tuple[int, int]:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def _stat(self) -> Tuple:
+        if not self.journal:
+            return self._file_stat(self.path)
+        journal_stat = self._file_stat(self.journal_path) if os.path.exists(self.journal_path) else None
+        return self._file_stat(self.path), journal_stat
+
+    def _build(self, items: List[Dict]) -> None:
+        """
+        重建内存中的目录及二级索引
+        :param items: List[Dict] 全量数据
+        """
+        indexes = {field: {} for field in self.index_fields}
+        for idx, item in enumerate(items):
+            for field in self.index_fields:
+                indexes[field].setdefault(item.get(field), []).append(idx)
+        self._items = items
+        self._indexes = indexes
+
+    def _extend(self, data: List[Dict]) -> None:
+        """
+        增量追加数据并更新索引
+        :param data: List[Dict] 新增的数据
+        """
+        start = len(self._items)
+        self._items.extend(data)
+        for idx, item in enumerate(data, start):
+            for field in self.index_fields:
+                self._indexes[field].setdefault(item.get(field), []).append(idx)
+
+    @staticmethod
+    def _remove(items: List[Dict], condition: Dict) -> List[Dict]:
+        """
+        :param items: List[Dict] 全量数据
+        :param condition: Dict[Str, Any] 删除条件, 任一值为空时不删除
+        :return: List[Dict] 删除后剩余的数据
+        """
+        result = []
+        for item in items:
+            flag = True
+            for k, v in condition.items():
+                if not v or item[k] != v:
+                    flag = False
+            if not flag:
+                result.append(item)
+        return result
+
+    @staticmethod
+    def _read_journal(path: str, base_stat: Tuple[int, int]) -> Optional[List[Dict]]:
+        """
+        读取日志记录. 日志首行记录了对应主文件的(mtime, size), 与当前主文件不一致说明日志已经合并过, 直接忽略
+        :param path: 日志文件路径
+        :param base_stat: 主文件的(mtime, size)
+        :return: List[Dict] 日志记录, 文件不存在或与主文件不对应时返回None
+        """
+        if not os.path.exists(path):
+            return None
+        records = None
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能只写了一半
+                    break
+                if records is None:
+                    if record.get("op") != "base" or tuple(record.get("stat", ())) != base_stat:
+                        return None
+                    records = []
+                    continue
+                records.append(record)
+        return records
+
+    def _recover(self) -> None:
+        """
+        合并时在两次rename之间崩溃: 主文件已经是新的, 新日志还在 <journal>.tmp 中, 首行与主文件一致, 补做第二次rename.
+        需要持有排他的文件锁
+        """
+        journal_tmp = "%s.tmp" % self.journal_path
+        if self._read_journal(journal_tmp, self._file_stat(self.path)) is not None:
+            os.replace(journal_tmp, self.journal_path)
+
+    def _apply(self, record: Dict) -> None:
+        if record["op"] == "add":
+            self._extend(record["data"])
+        elif record["op"] == "delete":
+            self._build(self._remove(self._items, record["condition"]))
+
+    def _load(self) -> Tuple[List[Dict], Dict[str, Dict[Any, List[int]]]]:
+        """
+        文件的mtime或大小发生变化时才重新解析, 否则直接返回内存中的目录
+        :return: (全量数据, 二级索引)
+        """
+        with self._lock:
+            signature = self._stat()
+            if signature == self._signature:
+                return self._items, self._indexes
+            if not self.journal:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._build(json.load(f))
+                self._signature = signature
+                return self._items, self._indexes
+            # 读取期间不允许其他进程合并, 主文件和日志要对应
+            with self._flock(shared=True):
+                signature = self._stat()
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._build(json.load(f))
+                records = self._read_journal(self.journal_path, signature[0])
+                if records is None:
+                    # 上次合并没有完成第二次rename, 合并期间的记录在 <journal>.tmp 中
+                    records = self._read_journal("%s.tmp" % self.journal_path, signature[0]) or []
+                for record in records:
+                    self._apply(record)
+                self._journal_records = len(records)
+                self._signature = signature
+            return self._items, self._indexes
+
+    def _store(self, data: List[Dict]) -> None:
+        """
+        原子地写回文件并同步内存中的目录
+        :param data: List[Dict] 全量数据
+        """
+        with self._flock():
+            _write_atomic(self.path, [json.dumps(data, ensure_ascii=False)])
+            self._build(data)
+            self._signature = self._stat()
+
+    def _append(self, record: Dict) -> None:
+        """
+        追加一条日志记录, 代价只和本次变更的数据量相关
+        :param record: Dict 日志记录
+        """
+        with self._flock():
+            self._recover()
+            self._load()
+            lines = []
+            if not os.path.exists(self.journal_path) or self._journal_records == 0:
+                lines.append(json.dumps({"op": "base", "stat": self._file_stat(self.path)}) + "\n")
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            with open(self.journal_path, "w" if len(lines) > 1 else "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(record)
+            self._journal_records += 1
+            self._signature = self._stat()
+            if self._journal_records < self.compact_threshold or self._compact_lock.locked():
+                return
+        if self.background_compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+        else:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        把日志合并回主文件: 写新主文件时不持有锁, 期间(任意进程)追加的记录在最后持锁时转入新日志, 再依次rename.
+        两次rename之间崩溃时, 新日志留在 <journal>.tmp, 首行与新主文件一致, 加载时读取它并在下次写入时补做rename
+        """
+        if not self.journal or not self._compact_lock.acquire(blocking=False):
+            return
+        # 主文件的临时文件在锁外写入, 按进程区分避免多个进程同时合并时互相覆盖
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        journal_tmp = "%s.tmp" % self.journal_path
+        try:
+            with self._flock():
+                self._recover()
+                items = list(self._load()[0])
+                if not self._journal_records:
+                    return
+                base_stat, merged = self._signature[0], self._journal_records
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._flock():
+                records = self._read_journal(self.journal_path, base_stat)
+                if self._file_stat(self.path) != base_stat or records is None:
+                    # 其他进程已经合并过
+                    os.remove(tmp)
+                    return
+                lines = [json.dumps({"op": "base", "stat": self._file_stat(tmp)}) + "\n"]
+                lines.extend(json.dumps(record, ensure_ascii=False) + "\n" for record in records[merged:])
+                with open(journal_tmp, "w", encoding="utf-8") as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                os.replace(journal_tmp, self.journal_path)
+                # 其他进程追加的记录不在内存中, 下次读取时重新加载
+                self._signature = None
+        except Exception as e:
+            print("compact action journal failed, error: %s" % str(e))
+        finally:
+            self._compact_lock.release()
+
+    def _match(self, condition: Dict) -> List[Dict]:
+        """
+        :param condition: Dict[Str, Any] 筛选条件, 值为空的条件忽略
+        :return: List[Dict] 匹配的原始数据
+        """
+        items, indexes = self._load()
+        condition = {k: v for k, v in condition.items() if v}
+        if not condition:
+            return list(items)
+        # 先用索引求候选集合(取最小的一个), 剩余条件再逐条比较
+        candidates = None
+        for k in self.index_fields:
+            if k not in condition:
+                continue
+            ids = indexes[k].get(condition[k], [])
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        if candidates is None:
+            candidates = range(len(items))
+        return [items[idx] for idx in candidates
+                if all(items[idx].get(k) == v for k, v in condition.items())]
 
     def add(self, data: List[Dict]) -> None:
         """
         :param data: List[Dict] 保存的数据
         """
         try:
-            with open(self.path, "r+", encoding="utf-8") as f:
-                _data = json.load(f)
+            if self.journal:
+                self._append({"op": "add", "data": data})
+                return
+            with self._flock():
+                _data = list(self._load()[0])
                 _data.extend(data)
-            with open(self.path, "w+", encoding="utf-8") as f:
-                json.dump(_data, f, ensure_ascii=False)
+                self._store(_data)
         except Exception as e:
             print("save action failed, error: %s" % str(e))
 
@@ -52,19 +345,11 @@ class ActionJSONHandler(ActionHandler):
         :param condition: List[str] 删除的命令
         """
         try:
-            with open(self.path, "r+", encoding="utf-8") as f:
-                _data = json.load(f)
-                _data: List[Dict]
-            with open(self.path, "w+", encoding="utf-8") as f:
-                result = []
-                for idx, item in enumerate(_data):
-                    flag = True
-                    for k, v in condition.items():
-                        if not v or item[k] != v:
-                            flag = False
-                    if not flag:
-                        result.append(item)
-                json.dump(result, f, ensure_ascii=False)
+            if self.journal:
+                self._append({"op": "delete", "condition": condition})
+                return
+            with self._flock():
+                self._store(self._remove(self._load()[0], condition))
         except Exception as e:
             print("delete action failed, error: %s" % str(e))
 
@@ -81,22 +366,59 @@ class ActionJSONHandler(ActionHandler):
         """
         result = []
         try:
-            with open(self.path, "r+", encoding="utf-8") as f:
-                data = json.load(f)
-                if not condition:
-                    return [Action.to_model(**item) for item in data]
-                for item in data:
-                    for k, v in condition.items():
-                        if not v:
-                            continue
-                        if item[k] != v:
-                            break
-                    else:
-                        result.append(Action.to_model(**item))
+            result = to_models(Action, self._match(condition or {}))
         except Exception as e:
             print("search action by condition failed, error: %s" % str(e))
         return result
 
+    def publish_snapshot(self, path: str) -> int:
+        """
+        :param path: 快照文件路径
+        :return: int 新快照的代数
+        """
+        return publish_snapshot(path, self._load()[0])
+
+
+class ActionSnapshotHandler(ActionHandler):
+    """
+    只读的共享快照, 由写入方通过 publish_snapshot 发布, 各worker mmap同一个文件
+    """
+
+    def __init__(self, location: str) -> None:
+        """
+        :param location: 快照文件的路径
+        """
+        if not os.path.exists(location):
+            raise Exception("%s path has no exists" % location)
+        self.snapshot = ActionSnapshot(location)
+
+    def add(self, data: List[Dict]) -> None:
+        raise Exception("action snapshot is read only")
+
+    def delete(self, data: Dict) -> None:
+        raise Exception("action snapshot is read only")
+
+    def update(self, data: Dict) -> None:
+        raise Exception("action snapshot is read only")
+
+    def get(self, condition: Optional[Dict] = None) -> List[Action]:
+        """
+        :param condition: Dict[Str, Any] 筛选条件
+        :return: List[Action]
+        """
+        return to_models(Action, self.snapshot.get(condition))
+
+    def scan(self, filters: Optional[Dict] = None, after_id: int = 0,
+             limit: Optional[int] = None) -> Iterator[Dict]:
+        """
+        与数据库查询的语义一致: 条件精确匹配(包括空值), 按id升序分页, 逐条从快照中解码
+        :param filters: Dict[Str, Any] 筛选条件
+        :param after_id: int 只返回id大于该值的数据
+        :param limit: int 最多返回的条数
+        :return: Iterator[Dict]
+        """
+        return self.snapshot.scan(filters, after_id, limit)
+
 
 action_json = ActionJSONHandler("action.json")
 # res = action_json.get({"vendor": "cisco", "model": "nexus"})  # get by conditions
@@ -107,57 +429,165 @@ print(res[0])
 
 
 class ActionORMHandler(ActionHandler):
-    def __init__(self, handler):
+    # 写入后立即重新生成最近使用的多少个/action/get响应
+    rebuild_responses = 8
+
+    def __init__(self, handler, snapshot_path: Optional[str] = None):
         # 初始化的时候接收一个handler参数，该参数就是SQLAlchemy的db实例，可以通过这个handler来操作数据库，实现增删改查
         self.handler = handler
+        # 配置了快照路径时, 每次写入后重新发布共享快照, 读取时直接查快照(各worker mmap同一个文件), 不再查数据库
+        self.snapshot_path = snapshot_path
+        self._snapshot: Optional[ActionSnapshotHandler] = None
+
+    @property
+    def snapshot(self) -> Optional[ActionSnapshotHandler]:
+        """
+        :return: ActionSnapshotHandler 快照尚未发布时返回None, 读取回退到数据库
+        """
+        if self._snapshot is None and self.snapshot_path and os.path.exists(self.snapshot_path):
+            self._snapshot = ActionSnapshotHandler(self.snapshot_path)
+        return self._snapshot
+
+    @staticmethod
+    def coerce(filters: Optional[Dict]) -> Dict:
+        """
+        按列类型转换查询参数中的字符串, 如 id="3" -> 3, 与filter_by的行为一致
+        """
+        columns = Action.__table__.columns
+        result = {}
+        for k, v in (filters or {}).items():
+            if isinstance(v, str) and k in columns:
+                try:
+                    if columns[k].type.python_type is int:
+                        v = int(v)
+                except (NotImplementedError, ValueError):
+                    pass
+            result[k] = v
+        return result
 
     def add(self, args: List[Dict]):
         if self.handler is None:
             raise Exception("has no active db handler")
-        actions = []
-        for item in args:
-            actions.append(Action.to_model(**item))
-        self.handler.add_all(actions)
+        # 只需要写入, 不构造ORM对象, 直接批量插入
+        bulk_insert(self.handler, Action, args)
         self.handler.commit()
+        self.publish_snapshot()
+        response_cache.invalidate(ACTIONS, rebuild=self.rebuild_responses)
 
     def delete(self, args: List[int]):
         if self.handler is None:
             raise Exception("has no active db handler")
         Action.query.filter(Action.id.in_(args)).delete()
         self.handler.commit()
+        parser_cache.invalidate(args)
+        self.publish_snapshot()
+        response_cache.invalidate(ACTIONS, rebuild=self.rebuild_responses)
 
-    def update(self, args: List[Dict]):
+    def update(self, args: List[Dict], batch_size: int = 500) -> List[Dict]:
+        """
+        按修改的列分组, 每组分批执行一次executemany, 而不是每行一条UPDATE
+        :param args: List[Dict] 更新的数据, 必须包含id
+        :param batch_size: int 每批的行数
+        :return: List[Dict] 每批更新的列及行数
+        """
         if self.handler is None:
             raise Exception("has no active db handler")
+        table = Action.__table__
+        columns = set(table.columns.keys())
+        groups: Dict[Tuple[str, ...], List[Dict]] = {}
         for item in args:
             if "id" not in item:
                 continue
-            Action.query.filter_by(id=item.pop("id")).update(item)
+            keys = tuple(sorted(k for k in item if k != "id" and k in columns))
+            if not keys:
+                continue
+            # 绑定参数名不能与列名相同, 加前缀区分
+            groups.setdefault(keys, []).append({"b_%s" % k: item[k] for k in ("id",) + keys})
+        result = []
+        for keys, rows in groups.items():
+            stmt = table.update() \
+                .where(table.c.id == bindparam("b_id")) \
+                .values({k: bindparam("b_%s" % k) for k in keys})
+            for i in range(0, len(rows), batch_size):
+                res = self.handler.execute(stmt, rows[i:i + batch_size])
+                result.append({"columns": list(keys), "count": res.rowcount})
         self.handler.commit()
+        parser_cache.invalidate(row["b_id"] for rows in groups.values() for row in rows)
+        self.publish_snapshot()
+        response_cache.invalidate(ACTIONS, rebuild=self.rebuild_responses)
+        return result
+
+    def publish_snapshot(self) -> Optional[int]:
+        """
+        :return: int 新快照的代数, 未配置快照路径时返回None
+        """
+        if not self.snapshot_path:
+            return None
+        serializer = serializer_for(Action)
+        # 查询也在锁内执行, 最后发布的一定是最后提交之后查到的数据
+        with snapshot_lock(self.snapshot_path):
+            items = (serializer.to_dict(item) for item in Action.query.order_by(Action.id).yield_per(1000))
+            return publish_snapshot(self.snapshot_path, items, lock=False)
 
     def get(self, filters: Optional[Dict] = None):
+        if self.snapshot is not None:
+            return to_models(Action, self.snapshot.scan(self.coerce(filters)))
         return Action.query.filter_by(**(filters or {})).all()
 
+    def scan(self, filters: Optional[Dict] = None, after_id: int = 0, limit: Optional[int] = None,
+             batch_size: int = 1000):
+        """
+        按id做keyset分页, 用yield_per分批取数据, 内存占用与总行数无关
+        :param filters: Dict[Str, Any] 筛选条件
+        :param after_id: int 游标, 只返回id大于该值的数据, 即上一页最后一条的id
+        :param limit: int 本页最多返回的条数, 为空时返回全部
+        :param batch_size: int 每次从数据库取的行数
+        :return: Iterator[Action], 从快照读取时为Iterator[Dict]
+        """
+        if self.snapshot is not None:
+            return self.snapshot.scan(self.coerce(filters), after_id, limit)
+        query = Action.query.filter_by(**(filters or {})).filter(Action.id > after_id).order_by(Action.id)
+        if limit:
+            query = query.limit(limit)
+        return query.yield_per(batch_size)
+
 
 import abc
+import asyncio
 import concurrent.futures
+import contextlib
 import json
 import logging
 import csv
+import io
+import queue
+import threading
 import traceback
-from datetime import datetime
-from typing import Any, List, Dict
-from flask import Config
+from datetime import date, datetime, timedelta
+import time
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from flask import Config, current_app, has_app_context
+from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from sqlalchemy.orm import scoped_session
-from sqlalchemy import and_
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from junior.flaskProject.application.services.executor import SSHExecutor
 from junior.flaskProject.utils import format_time
-from junior.flaskProject.application.models.inspection import Inspection as InspectionModel
+from app.models.inspection import Inspection as InspectionModel, InspectionOutput, InspectionParseCache, \
+    InspectionRollup
 from junior.flaskProject.application.services.action import ActionHandler
 from junior.flaskProject.application.services.device import DeviceHandler, Device
+from app.services.channel import close_connection, get_channel, send_batch
+from app.services.connection import ssh_pool
+from app.services.parser import ActionSpec, ResultCache, result_cache
+from app.services.partition import OUTPUT_GC_GRACE, InspectionPartitions
+from app.utils.blob import compress, decompress, digest
+from app.utils.columnar import update_schema, write_columns
+from app.utils.rollup import ROLLUP_KEYS, aggregate
 
 
 class InspectionHandler(abc.ABC):
@@ -170,130 +600,1046 @@ class InspectionHandler(abc.ABC):
     def add(self, data: List[Dict]) -> None:
         pass
 
+    @classmethod
+    @abc.abstractmethod
+    def collect(cls, device: Device, actions: List[Any], config: Dict, action_handler: ActionHandler,
+                logger: logging.Logger, deadline: Optional[float] = None) -> List[Dict]:
+        pass
+
+    @classmethod
+    @abc.abstractmethod
+    def analyze(cls, raw: List[Dict]) -> List[Dict]:
+        pass
+
     @classmethod
     @abc.abstractmethod
     def execute(cls, device: Device, actions: List[Any], config: Dict, action_handler: ActionHandler,
-                logger: logging.Logger) -> List[Dict]:
+                logger: logging.Logger, deadline: Optional[float] = None) -> List[Dict]:
+        pass
+
+    @classmethod
+    async def execute_async(cls, device: Device, actions: List[Any], config: Dict, action_handler: ActionHandler,
+                            logger: logging.Logger, executor: concurrent.futures.Executor,
+                            deadline: Optional[float] = None) -> List[Dict]:
+        """
+        默认把阻塞的execute放到线程池中执行, 支持异步SSH的实现可以覆盖该方法
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, cls.execute, device, actions, config, action_handler, logger, deadline)
+
+    @abc.abstractmethod
+    def durations(self, sns: List[str]) -> Dict[str, float]:
         pass
 
     @abc.abstractmethod
-    def export(self, device_handler: DeviceHandler, start_time: int, end_time: int) -> None:
+    def load_parse_cache(self, action_ids: List[int]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def export(self, device_handler: DeviceHandler, start_time: int, end_time: int) -> str:
         pass
 
 
 class InspectionORMHandler(InspectionHandler):
 
-    def __init__(self, db_handler: scoped_session):
+    def __init__(self, db_handler: scoped_session, partitioned: Optional[bool] = None):
+        """
+        :param partitioned: 是否按月分区存储, 默认读取配置INSPECTION_PARTITION
+        """
         self.db_handler = db_handler
+        if partitioned is None:
+            partitioned = current_app.config.get("INSPECTION_PARTITION", False) if has_app_context() else False
+        self.partitions = InspectionPartitions(db_handler, partitioned)
 
     def add(self, data: List[Dict]):
         if self.db_handler is None:
             raise Exception("has no active db handler")
+        # 没有巡检时间的记录在这里补上, 写入的记录和汇总使用同一个时间
+        now = datetime.now()
+        for row in data:
+            if not row.get("timestamp"):
+                row["timestamp"] = now
+        entries = result_cache.drain()
+        try:
+            self.store_outputs(data)
+            if self.partitions.monthly:
+                self.partitions.insert(data)
+            else:
+                bulk_insert(self.db_handler, InspectionModel, data)
+            self.save_parse_cache(entries)
+            # 汇总表与巡检记录在同一个事务中更新
+            self.save_rollup(aggregate(data))
+            self.db_handler.commit()
+        except Exception:
+            # 回滚已执行的语句, 否则会随下一批一起提交; 未落库的解析结果放回, 由下一批写入
+            self.db_handler.rollback()
+            result_cache.restore(entries)
+            raise
+
+    def insert_ignore(self, table: Any, rows: List[Dict]) -> None:
+        """
+        批量插入, 主键冲突的行忽略
+        """
+        stmt = table.insert()
+        dialect = self.db_handler.get_bind().dialect.name
+        if dialect == "sqlite":
+            stmt = stmt.prefix_with("OR IGNORE")
+        elif dialect == "mysql":
+            stmt = stmt.prefix_with("IGNORE")
+        self.db_handler.execute(stmt, rows)
+
+    def save_parse_cache(self, entries: Dict[Tuple[Any, str, str], Tuple[Any, Any]]) -> None:
+        """
+        :param entries: ResultCache.drain()取出的新增记录
+        """
+        rows = []
+        for (action_id, parse_digest, output_hash), (parse_result, validation_result) in entries.items():
+            try:
+                rows.append({
+                    "action_id": action_id,
+                    "parse_digest": parse_digest,
+                    "output_hash": output_hash,
+                    "parse_result": json.dumps(parse_result, ensure_ascii=False),
+                    "validation_result": json.dumps(validation_result, ensure_ascii=False),
+                })
+            except (TypeError, ValueError):
+                continue
+        if rows:
+            self.insert_ignore(InspectionParseCache.__table__, rows)
+
+    def save_rollup(self, deltas: Dict[Tuple, Dict[str, Any]]) -> None:
+        """
+        把一批记录的汇总增量原子地累加到inspection_rollup, 多个巡检进程同时写入也不会丢失计数
+        :param deltas: app.utils.rollup.aggregate的结果
+        """
+        if not deltas:
+            return
+        table = InspectionRollup.__table__
+        rows = [dict(zip(ROLLUP_KEYS, key), **stat) for key, stat in deltas.items()]
+        dialect = self.db_handler.get_bind().dialect.name
+        if dialect not in ("mysql", "sqlite"):
+            for row in rows:
+                current = self.db_handler.get(InspectionRollup, tuple(row[k] for k in ROLLUP_KEYS))
+                if current is None:
+                    self.db_handler.add(InspectionRollup(**row))
+                    continue
+                current.pass_count += row["pass_count"]
+                current.fail_count += row["fail_count"]
+                current.value_count += row["value_count"]
+                current.value_sum += row["value_sum"]
+                values = [v for v in (current.value_min, row["value_min"]) if v is not None]
+                current.value_min = min(values) if values else None
+                values = [v for v in (current.value_max, row["value_max"]) if v is not None]
+                current.value_max = max(values) if values else None
+            return
+        stmt = mysql_insert(table) if dialect == "mysql" else sqlite_insert(table)
+        new = stmt.inserted if dialect == "mysql" else stmt.excluded
+        least, greatest = (func.least, func.greatest) if dialect == "mysql" else (func.min, func.max)
+        merged = {
+            "pass_count": table.c.pass_count + new.pass_count,
+            "fail_count": table.c.fail_count + new.fail_count,
+            "value_count": table.c.value_count + new.value_count,
+            "value_sum": table.c.value_sum + new.value_sum,
+            # 任一侧为NULL时取另一侧
+            "value_min": least(func.coalesce(table.c.value_min, new.value_min),
+                               func.coalesce(new.value_min, table.c.value_min)),
+            "value_max": greatest(func.coalesce(table.c.value_max, new.value_max),
+                                  func.coalesce(new.value_max, table.c.value_max)),
+        }
+        if dialect == "mysql":
+            stmt = stmt.on_duplicate_key_update(**merged)
+        else:
+            stmt = stmt.on_conflict_do_update(index_elements=list(ROLLUP_KEYS), set_=merged)
+        self.db_handler.execute(stmt, rows)
+
+    def query_rollup(self, start_day: date, end_day: date, group_by: Tuple[str, ...] = ROLLUP_KEYS,
+                     **filters: Any) -> List[Dict]:
+        """
+        从汇总表查询, 代价与分组数相关, 与原始记录数无关
+        :param start_day: 开始日期, 包含
+        :param end_day: 结束日期, 包含
+        :param group_by: 分组维度, ROLLUP_KEYS的子集, 如("day", "idc")
+        :param filters: 维度筛选, 值为列表时为IN, 如 idc=["bj1"], metric="*"
+        :return: List[Dict] 每组的pass_count/fail_count/value_count/value_min/value_max/value_avg
+        """
+        for name in list(group_by) + list(filters):
+            if name not in ROLLUP_KEYS:
+                raise Exception("unknown rollup dimension %s" % name)
+        dims = [getattr(InspectionRollup, name) for name in group_by]
+        query = self.db_handler.query(
+            *dims,
+            func.sum(InspectionRollup.pass_count).label("pass_count"),
+            func.sum(InspectionRollup.fail_count).label("fail_count"),
+            func.sum(InspectionRollup.value_count).label("value_count"),
+            func.sum(InspectionRollup.value_sum).label("value_sum"),
+            func.min(InspectionRollup.value_min).label("value_min"),
+            func.max(InspectionRollup.value_max).label("value_max"),
+        ).filter(InspectionRollup.day >= start_day, InspectionRollup.day <= end_day)
+        for name, value in filters.items():
+            if value is None:
+                continue
+            column = getattr(InspectionRollup, name)
+            query = query.filter(column.in_(value) if isinstance(value, (list, tuple, set)) else column == value)
+        if dims:
+            query = query.group_by(*dims).order_by(*dims)
         result = []
-        for item in data:
-            result.append(InspectionModel.to_model(**item))
-        self.db_handler.add_all(result)
+        for row in query:
+            item = dict(row._mapping)
+            item["pass_count"] = int(item["pass_count"] or 0)
+            item["fail_count"] = int(item["fail_count"] or 0)
+            item["value_count"] = int(item["value_count"] or 0)
+            value_sum = item.pop("value_sum") or 0.0
+            item["value_avg"] = value_sum / item["value_count"] if item["value_count"] else None
+            result.append(item)
+        return result
+
+    def rebuild_rollup(self, device_handler: DeviceHandler, start_day: date, end_day: date,
+                       batch_size: int = 10000) -> None:
+        """
+        按原始记录重新计算若干天的汇总, 用于补齐上线前的历史数据
+        :param start_day: 开始日期, 包含
+        :param end_day: 结束日期, 包含
+        """
+        start_time = datetime.combine(start_day, datetime.min.time())
+        end_time = datetime.combine(end_day + timedelta(days=1), datetime.min.time())
+        self.db_handler.query(InspectionRollup) \
+            .filter(InspectionRollup.day >= start_day, InspectionRollup.day <= end_day) \
+            .delete(synchronize_session=False)
+        window = self.partitions.window(
+            ["sn", "action_id", "timestamp", "validation_result"], start_time, end_time,
+            lambda t: and_(t.c.timestamp >= start_time, t.c.timestamp < end_time))
+        query = self.db_handler.query(window.c.sn, window.c.action_id, window.c.timestamp, window.c.validation_result) \
+            .yield_per(batch_size)
+        rows = []
+
+        def flush():
+            sn_map = {item.sn: item for item in device_handler.get_by_sn(list({row["sn"] for row in rows}))}
+            for row in rows:
+                device = sn_map.get(row["sn"])
+                row["idc"] = getattr(device, "idc", None)
+                row["vendor"] = getattr(device, "vendor", None)
+            self.save_rollup(aggregate(rows))
+            rows.clear()
+
+        for sn, action_id, timestamp, validation_result in query:
+            rows.append({"sn": sn, "action_id": action_id, "timestamp": timestamp,
+                         "validation_result": validation_result})
+            if len(rows) >= batch_size:
+                flush()
+        if rows:
+            flush()
         self.db_handler.commit()
 
+    def maintain(self, retention_days: int, downsample_days: int = 0, months_ahead: int = 3,
+                 parse_cache_days: int = 30) -> Dict[str, Any]:
+        """
+        分区维护任务, 建议每天执行: 预建分区, 降采样, 删除过期记录, 清理无引用的回显和过期的解析结果缓存
+        :param retention_days: 巡检记录保留天数, 更早的只保留inspection_rollup中的每日汇总
+        :param downsample_days: 超过该天数的记录每天只保留最后一条, 为0时不降采样
+        :param months_ahead: MySQL预建之后几个月的分区
+        :param parse_cache_days: 解析结果缓存保留天数, 解析内容或校验逻辑变更后的旧记录由此清理
+        :return: Dict 各步骤的结果
+        """
+        now = datetime.now()
+        result = {"created": self.partitions.ensure_partitions(months_ahead)}
+        if downsample_days:
+            result["downsampled"] = self.partitions.downsample(now - timedelta(days=downsample_days))
+        result.update(self.partitions.expire(now - timedelta(days=retention_days)))
+        result["outputs_removed"] = self.partitions.gc_outputs()
+        result["parse_cache_removed"] = self.prune_parse_cache(now - timedelta(days=parse_cache_days))
+        return result
+
+    def prune_parse_cache(self, before: datetime) -> int:
+        """
+        删除before之前写入的解析结果缓存, 按动作逐个删除并提交, 仍在使用的结果下次巡检时重新写入
+        :return: int 删除的记录数
+        """
+        deleted = 0
+        action_ids = [action_id for action_id, in self.db_handler.query(InspectionParseCache.action_id)
+                      .filter(InspectionParseCache.updated_at < before).distinct()]
+        for action_id in action_ids:
+            deleted += self.db_handler.query(InspectionParseCache) \
+                .filter(InspectionParseCache.action_id == action_id, InspectionParseCache.updated_at < before) \
+                .delete(synchronize_session=False)
+            self.db_handler.commit()
+        return deleted
+
+    def load_parse_cache(self, action_ids: List[int]) -> None:
+        """
+        把本次巡检涉及的动作的历史解析结果加载到内存
+        :param action_ids: List[int] 动作id
+        """
+        rows = self.db_handler.query(InspectionParseCache) \
+            .filter(InspectionParseCache.action_id.in_(action_ids)) \
+            .order_by(InspectionParseCache.updated_at.desc()) \
+            .limit(result_cache.maxsize) \
+            .all()
+        for row in reversed(rows):
+            result_cache.put((row.action_id, row.parse_digest, row.output_hash),
+                             json.loads(row.parse_result), json.loads(row.validation_result), dirty=False)
+
+    def store_outputs(self, data: List[Dict], chunk_size: int = 500) -> None:
+        """
+        回显按内容去重压缩后存入inspection_output, 巡检记录只保留output_hash.
+        同型号设备的同一条命令往往回显完全相同, 只需要存一份
+        :param data: List[Dict] 待保存的巡检记录, 原地替换output为output_hash
+        """
+        outputs = {}
+        for item in data:
+            output = item.pop("output", None)
+            if output is None:
+                continue
+            item["output_hash"] = item.get("output_hash") or digest(output)
+            outputs[item["output_hash"]] = output
+        hashes = list(outputs)
+        now = datetime.now()
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            # 先刷新将要复用的回显的时间, 清理任务在宽限期内不会删除它们; 在此之前已被删除的回显下面会重新写入.
+            # 只刷新超过半个宽限期的, 大部分批次不需要写
+            self.db_handler.query(InspectionOutput) \
+                .filter(InspectionOutput.hash.in_(chunk), InspectionOutput.created_at < now - OUTPUT_GC_GRACE / 2) \
+                .update({InspectionOutput.created_at: now}, synchronize_session=False)
+            existing = {h for h, in self.db_handler.query(InspectionOutput.hash)
+                        .filter(InspectionOutput.hash.in_(chunk))}
+            rows = []
+            for h in chunk:
+                if h in existing:
+                    continue
+                codec, blob = compress(outputs[h])
+                rows.append({"hash": h, "codec": codec, "size": len(outputs[h].encode("utf-8")), "data": blob,
+                             "created_at": now})
+            if not rows:
+                continue
+            # 并发写入同一份回显时以先写入的为准
+            self.insert_ignore(InspectionOutput.__table__, rows)
+
+    def get_output(self, inspection: InspectionModel) -> Optional[str]:
+        """
+        :param inspection: Inspection 巡检记录
+        :return: str 原始回显
+        """
+        if not inspection.output_hash:
+            return inspection.output
+        blob = self.db_handler.get(InspectionOutput, inspection.output_hash)
+        return decompress(blob.codec, blob.data) if blob else None
+
     @staticmethod
     def check_version(result: List[Dict]) -> List[Dict]:
         pass
 
+    def durations(self, sns: List[str], days: int = 7, batch_size: int = 500) -> Dict[str, float]:
+        """
+        :param sns: List[str] 设备sn
+        :param days: int 统计最近多少天的巡检记录
+        :param batch_size: int 每次查询中sn参数的总数上限
+        :return: Dict[sn, 平均巡检耗时]
+        """
+        since = datetime.now() - timedelta(days=days)
+        sns = list(sns)
+        result = {}
+        # IN列表分段, 避免SQLite的too many SQL variables; 分表时UNION的每张表都会带上这个列表
+        step = max(1, batch_size // len(self.partitions.tables(since, None)))
+        for i in range(0, len(sns), step):
+            chunk = sns[i:i + step]
+            window = self.partitions.window(
+                ["sn", "duration"], since, None,
+                lambda t: and_(t.c.sn.in_(chunk), t.c.timestamp > since, t.c.duration.isnot(None)))
+            rows = self.db_handler.query(window.c.sn, func.avg(window.c.duration)) \
+                .group_by(window.c.sn) \
+                .all()
+            result.update((sn, float(duration)) for sn, duration in rows)
+        return result
+
+    @classmethod
+    def collect(cls, device: Device, actions: List[Any], config: Dict, action_handler: ActionHandler,
+                logger: logging.Logger, deadline: Optional[float] = None) -> List[Dict]:
+        """
+        只做SSH I/O, 返回每个动作的原始回显
+        :param deadline: time.monotonic()时间, 超过后不再执行剩余的动作
+        :return: List[Dict] [{"action": Action, "output": str}]
+        """
+        def connect() -> SSHExecutor:
+            return SSHExecutor(
+                username=config.get("SSH_USERNAME"),
+                password=config.get("SSH_PASSWORD"),
+                secret=config.get("SSH_SECRET"),
+                device=device,
+                logger=logger)
+
+        # 开启连接池时复用上一次巡检留下的会话
+        session = ssh_pool.session(device.sn, connect) if config.get("SSH_POOL") else connect()
+        with session as ssh:
+            ssh.result = []
+            channel = get_channel(ssh) if config.get("SSH_PIPELINE") else None
+            # ssh.execute不接受超时参数, 到期时由定时器关闭连接, 打断阻塞中的命令
+            expired = threading.Event()
+            timer = None
+            if deadline is not None:
+                def expire():
+                    expired.set()
+                    close_connection(ssh)
+
+                timer = threading.Timer(max(0.0, deadline - time.monotonic()), expire)
+                timer.daemon = True
+                timer.start()
+            try:
+                for batch in cls.batches(actions, channel is not None):
+                    if expired.is_set() or deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError(f"{device.hostname} exceeded its deadline before {batch[0].name}")
+                    if len(batch) > 1:
+                        # 连续的show类命令一次性发送, 按提示符切分回显
+                        timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else 60.0
+                        outputs = send_batch(channel, [action.cmd for action in batch], timeout=timeout)
+                        ssh.result.extend(
+                            {"action": action, "output": output} for action, output in zip(batch, outputs))
+                        continue
+                    ssh.execute(action=batch[0], action_handler=action_handler, parse=False)
+                # 连接已被关闭, 抛出异常让连接池丢弃该会话
+                if expired.is_set():
+                    raise TimeoutError(f"{device.hostname} exceeded its deadline")
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            return ssh.result
+
+    @staticmethod
+    def batches(actions: List[Any], pipeline: bool) -> List[List[Any]]:
+        """
+        把连续的show类动作合并为一批, config类动作和它前后的动作保持原有顺序逐条执行
+        :param pipeline: 是否合并
+        :return: List[List[Action]]
+        """
+        if not pipeline:
+            return [[action] for action in actions]
+        result = []
+        for action in actions:
+            if action.type == "show" and result and result[-1][-1].type == "show":
+                result[-1].append(action)
+            else:
+                result.append([action])
+        return result
+
+    @classmethod
+    def lookup(cls, res: Dict) -> Tuple[str, Optional[Tuple[Any, Any]]]:
+        """
+        :param res: Dict collect的单条结果
+        :return: (回显摘要, 缓存的(解析结果, 校验结果)), 未命中时后者为None
+        """
+        output_hash = digest(res["output"])
+        return output_hash, result_cache.get(ResultCache.key(res["action"], output_hash, cls))
+
+    @staticmethod
+    def make_row(res: Dict, output_hash: str, parse_result: Any, validation_result: Any, cache_hit: bool) -> Dict:
+        return {
+            "action_id": res["action"].id,
+            "output": res["output"],
+            "output_hash": output_hash,
+            "parse_result": parse_result,
+            "validation_result": validation_result,
+            "cache_hit": cache_hit,
+        }
+
+    @classmethod
+    def analyze(cls, raw: List[Dict]) -> List[Dict]:
+        """
+        解析并校验原始回显, 属于CPU密集的部分, 可以放到进程池中执行.
+        回显与之前某次完全相同时直接复用当时的结果
+        :param raw: List[Dict] collect的结果
+        :return: List[Dict]
+        """
+        result = []
+        for res in raw:
+            output_hash, cached = cls.lookup(res)
+            if cached is not None:
+                result.append(cls.make_row(res, output_hash, cached[0], cached[1], True))
+                continue
+            # 解析器按动作编译一次后在进程内复用
+            parse_result = parser_cache.parse(res["action"], res["output"])
+            validation_func = None
+            if hasattr(cls, res["action"].name):
+                validation_func = getattr(cls, res["action"].name)
+            validation_result = validation_func(parse_result) if validation_func else parse_result
+            result_cache.put(ResultCache.key(res["action"], output_hash, cls), parse_result, validation_result)
+            result.append(cls.make_row(res, output_hash, parse_result, validation_result, False))
+        return result
+
     @classmethod
     def execute(cls, device: Device, actions: List[Any], config: Dict, action_handler: ActionHandler,
-                logger: logging.Logger) -> List[Dict]:
+                logger: logging.Logger, deadline: Optional[float] = None) -> List[Dict]:
         result = []
         try:
-            with SSHExecutor(
-                    username=config.get("SSH_USERNAME"),
-                    password=config.get("SSH_PASSWORD"),
-                    secret=config.get("SSH_SECRET"),
-                    device=device,
-                    logger=logger) as ssh:
-                for action in actions:
-                    ssh.execute(action=action, action_handler=action_handler, parse=True)
-                    ssh_result = ssh.result
-            for res in ssh_result:
-                validation_func = None
-                if hasattr(cls, res["action"].name):
-                    validation_func = getattr(cls, res["action"].name)
-                validation_result = validation_func(res["parse_result"]) if validation_func else res["parse_result"]
-                result.append({
-                    "action_id": res["action"].id,
-                    "output": res["output"],
-                    "parse_result": res["parse_result"],
-                    "validation_result": validation_result,
-                })
+            result = cls.analyze(cls.collect(device, actions, config, action_handler, logger, deadline))
         except Exception:
             logger.error(f"execute {device.hostname} failed, err: {traceback.format_exc()}")
         return result
 
-    def export(self, device_handler: DeviceHandler, start_time: datetime, end_time: datetime) -> None:
-        data = InspectionModel.query \
-            .filter(
-            and_(InspectionModel.timestamp > start_time, InspectionModel.timestamp < end_time)) \
-            .all()
-        device_list = device_handler.get_by_sn([item.sn for item in data])
-        sn_map = {item.sn: item for item in device_list}
-        header = {"hostname"}
-        device_result = {}
-        for result in data:
-            device = sn_map.get(result.sn)
-            if not device:
+    def export(self, device_handler: DeviceHandler, start_time: datetime, end_time: datetime) -> str:
+        """
+        :return: str 导出的文件名
+        """
+        filename = f"export_{format_time(0)}.csv"
+        with open(filename, "w+", newline="") as f:
+            for chunk in self.iter_export(device_handler, start_time, end_time):
+                f.write(chunk)
+        return filename
+
+    def export_header(self, start_time: datetime, end_time: datetime, batch_size: int = 10000) -> List[str]:
+        """
+        预扫描: 只读取校验结果, 取时间段内所有记录所有条目的字段并集作为列, 任何字段都不会在导出时丢失
+        :return: List[str] 表头, 按字段首次出现的顺序
+        """
+        header = {"hostname": None}
+        window = self.partitions.window(
+            ["validation_result"], start_time, end_time,
+            lambda t: and_(t.c.timestamp > start_time, t.c.timestamp < end_time))
+        for validation_result, in self.db_handler.query(window.c.validation_result).yield_per(batch_size):
+            try:
+                result_dict = self.load_validation_result(validation_result)
+            except Exception:
                 continue
+            for item in result_dict:
+                if isinstance(item, dict):
+                    header.update(dict.fromkeys(item))
+        return list(header)
+
+    @staticmethod
+    def load_validation_result(validation_result: str) -> List[Dict]:
+        result_dict = json.loads(validation_result)
+        return [result_dict] if isinstance(result_dict, dict) else result_dict
+
+    def iter_export(self, device_handler: DeviceHandler, start_time: datetime, end_time: datetime,
+                    batch_size: int = 1000):
+        """
+        单次扫描流式导出: 按sn顺序读取, 一台设备的记录读完即写出一行, 每攒够batch_size台设备批量查一次主机名
+        :return: Iterator[str] CSV内容片段
+        """
+        header = self.export_header(start_time, end_time)
+        buffer = io.StringIO()
+        # 表头已包含全部字段, 出现表头之外的字段说明两次扫描之间数据有变化, 直接报错而不是静默丢弃
+        writer = csv.DictWriter(buffer, fieldnames=header)
+        writer.writeheader()
+
+        def drain() -> str:
+            content = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return content
+
+        def write(pending: Dict[str, Dict]) -> str:
+            sn_map = {item.sn: item for item in device_handler.get_by_sn(list(pending))}
+            for sn, row in pending.items():
+                device = sn_map.get(sn)
+                if device:
+                    writer.writerow({**row, "hostname": device.hostname})
+            return drain()
+
+        yield drain()
+        window = self.partitions.window(
+            ["sn", "validation_result", "timestamp", "id"], start_time, end_time,
+            lambda t: and_(t.c.timestamp > start_time, t.c.timestamp < end_time))
+        query = self.db_handler.query(window.c.sn, window.c.validation_result) \
+            .order_by(window.c.sn, window.c.timestamp, window.c.id) \
+            .yield_per(batch_size)
+        pending: Dict[str, Dict] = {}
+        for sn, validation_result in query:
+            if sn not in pending and len(pending) >= batch_size:
+                yield write(pending)
+                pending = {}
             try:
-                result_dict = json.loads(result.validation_result)
+                result_dict = self.load_validation_result(validation_result)
             except Exception:
-                pass
                 continue
-            for col in result_dict[0].keys():
-                header.add(col)
-            for row in result_dict:
-                device_result.setdefault(device.hostname, {}).update(row)
+            row = pending.setdefault(sn, {})
+            for item in result_dict:
+                if isinstance(item, dict):
+                    row.update(item)
+        if pending:
+            yield write(pending)
 
-        with open(f"export_{format_time(0)}.csv", "w+") as f:
-            writer = csv.DictWriter(f, fieldnames=list(header))
-            writer.writeheader()
-            for hostname in device_result:
-                writer.writerows([{"hostname": hostname, **device_result[hostname]}])
+    def export_columnar(self, device_handler: DeviceHandler, start_time: datetime, end_time: datetime,
+                        directory: Optional[str] = None, part_rows: int = 100000) -> List[str]:
+        """
+        按天分区导出列式文件, validation_result中的每个字段单独成列, 分析时只需读取用到的列.
+        先扫描一遍validation_result确定全部列及其类型, 所有文件使用同一个schema, 可以作为一个数据集读取
+        :param directory: 导出目录, 默认为export_<时间>
+        :param part_rows: 每个文件最多的行数
+        :return: List[str] 导出的文件路径, 如 <directory>/day=2024-01-01/part-0000.parquet
+        """
+        directory = directory or f"export_{format_time(0)}"
+        files = []
+        state = {"day": None, "part": 0}
+        rows: List[Dict] = []
+        window = self.partitions.window(
+            ["sn", "action_id", "timestamp", "validation_result"], start_time, end_time,
+            lambda t: and_(t.c.timestamp > start_time, t.c.timestamp < end_time))
+        schema = {"sn": "str", "hostname": "str", "action_id": "int", "timestamp": "datetime"}
+        fixed = set(schema)
+        for validation_result, in self.db_handler.query(window.c.validation_result).yield_per(10000):
+            try:
+                for item in self.load_validation_result(validation_result):
+                    # 与固定列同名的字段会被覆盖, 不参与推断
+                    update_schema(schema, {k: v for k, v in item.items() if k not in fixed})
+            except Exception:
+                continue
+
+        def write():
+            if not rows:
+                return
+            sn_map = {item.sn: item for item in device_handler.get_by_sn(list({row["sn"] for row in rows}))}
+            for row in rows:
+                device = sn_map.get(row["sn"])
+                row["hostname"] = device.hostname if device else None
+            columns = {col: [row.get(col) for row in rows] for col in schema}
+            partition = os.path.join(directory, f"day={state['day']}")
+            os.makedirs(partition, exist_ok=True)
+            files.append(write_columns(os.path.join(partition, "part-%04d" % state["part"]), columns, schema))
+            state["part"] += 1
+            rows.clear()
+
+        query = self.db_handler.query(window.c.sn, window.c.action_id, window.c.timestamp, window.c.validation_result) \
+            .order_by(window.c.timestamp) \
+            .yield_per(10000)
+        for sn, action_id, timestamp, validation_result in query:
+            day = timestamp.strftime("%Y-%m-%d")
+            if day != state["day"] or len(rows) >= part_rows:
+                write()
+                if day != state["day"]:
+                    state["day"], state["part"] = day, 0
+            try:
+                result_dict = self.load_validation_result(validation_result)
+            except Exception:
+                continue
+            for item in result_dict:
+                rows.append({**item, "sn": sn, "action_id": action_id, "timestamp": timestamp})
+        write()
+        return files
+
+
+def _analyze_batch(handler_cls: type,
+                   batch: List[Tuple[str, List[Dict], float]]) -> List[Tuple[str, List[Dict], float, str]]:
+    """
+    在解析进程中执行, 单台设备失败不影响同一批的其他设备
+    :param handler_cls: InspectionHandler的子类
+    :param batch: List[(sn, 原始回显, 采集耗时)]
+    :return: List[(sn, 结果, 采集耗时, 错误信息)]
+    """
+    result = []
+    for sn, raw, duration in batch:
+        try:
+            result.append((sn, handler_cls.analyze(raw), duration, ""))
+        except Exception:
+            result.append((sn, [], duration, traceback.format_exc()))
+    return result
+
+
+class ResultBuffer:
+    """
+    有界的结果缓冲: 设备完成后放入缓冲, 由单独的写线程按条数或时间间隔批量落库
+    """
+    _CLOSE = object()
+
+    def __init__(self, writer: Callable[[List[Dict]], None], logger: logging.Logger, batch_size: int = 1000,
+                 interval: float = 5.0, max_pending: int = 256) -> None:
+        """
+        :param writer: 批量写入函数, 一般为inspection_handler.add
+        :param batch_size: 攒够多少行写一次
+        :param interval: 最长多少秒写一次
+        :param max_pending: 最多缓冲的设备数, 写入跟不上时put会阻塞
+        """
+        self.writer = writer
+        self.logger = logger
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        # 写线程中复用调用方的应用上下文, 保证数据库会话可用
+        self._app = current_app._get_current_object() if has_app_context() else None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, rows: List[Dict]) -> None:
+        self._queue.put(rows)
+
+    def close(self) -> None:
+        """
+        写完缓冲中剩余的数据后退出
+        """
+        self._queue.put(self._CLOSE)
+        self._thread.join()
+
+    def _flush(self, batch: List[Dict]) -> None:
+        if not batch:
+            return
+        try:
+            self.writer(batch)
+        except Exception:
+            self.logger.error(f"save {len(batch)} inspection rows failed, err: {traceback.format_exc()}")
+
+    def _run(self) -> None:
+        with self._app.app_context() if self._app is not None else contextlib.nullcontext():
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = None
+                if item is self._CLOSE:
+                    self._flush(batch)
+                    return
+                if item:
+                    batch.extend(item)
+                if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                    self._flush(batch)
+                    batch = []
+                    deadline = time.monotonic() + self.interval
 
 
 class InspectionService:
+    # 采集阶段结束的标记
+    _DONE = object()
+
     def __init__(
             self,
             config: Config,
             action_handler: ActionHandler,
             inspection_handler: InspectionHandler,
             logger: logging.Logger,
-            max_workers: int = 8) -> None:
+            max_workers: int = 8,
+            parse_workers: int = 0,
+            parse_batch_size: int = 32,
+            queue_size: int = 256,
+            mode: str = "thread",
+            concurrency: int = 64,
+            idc_limit: int = 0,
+            vendor_limit: int = 0,
+            keep_result: bool = True,
+            flush_size: int = 1000,
+            flush_interval: float = 5.0,
+            device_timeout: Optional[float] = None,
+            run_timeout: Optional[float] = None) -> None:
+        """
+        :param max_workers: SSH采集线程数
+        :param parse_workers: 解析进程数, 为0时在采集线程中直接解析
+        :param parse_batch_size: 每次提交给解析进程的设备数
+        :param queue_size: 采集结果队列的容量, 解析跟不上时阻塞采集线程
+        :param mode: 执行方式[thread|asyncio]. asyncio方式只是用事件循环调度和按机房/厂商限流, SSH仍是阻塞调用,
+            在concurrency个线程的线程池中执行, 并发上限就是线程数, 除非InspectionHandler用异步SSH覆盖execute_async
+        :param concurrency: asyncio方式下同时巡检的设备数, 也是执行阻塞SSH的线程池大小, 按主机能承受的线程数设置
+        :param idc_limit: asyncio方式下每个机房同时巡检的设备数, 为0时不限制
+        :param vendor_limit: asyncio方式下每个厂商同时巡检的设备数, 为0时不限制
+        :param keep_result: 是否在内存中保留全部结果并由run返回, 结果已经边跑边落库
+        :param flush_size: 攒够多少行结果写一次库
+        :param flush_interval: 最长多少秒写一次库
+        :param device_timeout: 单台设备的期限(秒), 超过后不再执行剩余的动作
+        :param run_timeout: 整次巡检的期限(秒), 超过后取消未开始的设备, 不再等待执行中的设备
+        """
         self.config = config
         self.action_handler = action_handler
         self.inspection_handler = inspection_handler
         self.logger = logger
         self.max_workers = max_workers
+        self.parse_workers = parse_workers
+        self.parse_batch_size = parse_batch_size
+        self.queue_size = queue_size
+        self.mode = mode
+        self.concurrency = concurrency
+        self.idc_limit = idc_limit
+        self.vendor_limit = vendor_limit
+        self.keep_result = keep_result
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.device_timeout = device_timeout
+        self.run_timeout = run_timeout
         self.result: Dict[str, List[Dict]] = {}
+        # 本次巡检的统计, 包括解析结果缓存的命中率
+        self.summary: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._buffer: Optional[ResultBuffer] = None
+        self._pending: Dict[str, Tuple[Dict[int, Dict], List[Tuple[int, Dict]]]] = {}
+        # sn -> Device, 落库时带上机房和厂商用于汇总
+        self._devices: Dict[str, Device] = {}
 
     def run(self, device_list: List[Device], actions: List[Any]) -> Dict[str, List[Dict]]:
-        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
-            for device in device_list:
-                future: concurrent.futures.Future = pool.submit(
-                    self.inspection_handler.execute, device, actions, self.config, self.action_handler, self.logger)
-                future.sn = device.sn
-                future.add_done_callback(self.execute_callback)
-        self.save()
+        device_list = self.schedule(device_list)
+        self._devices = {device.sn: device for device in device_list}
+        self.summary = {"devices": 0, "results": 0, "cache_hits": 0, "hit_rate": 0.0}
+        try:
+            self.inspection_handler.load_parse_cache([action.id for action in actions])
+        except Exception:
+            self.logger.error(f"load parse cache failed, err: {traceback.format_exc()}")
+        run_deadline = time.monotonic() + self.run_timeout if self.run_timeout else None
+        self._buffer = ResultBuffer(
+            self.inspection_handler.add, self.logger, self.flush_size, self.flush_interval, self.queue_size)
+        try:
+            if self.mode == "asyncio":
+                asyncio.run(self.run_async(device_list, actions, run_deadline))
+            elif self.parse_workers > 0:
+                self.run_pipeline(device_list, actions, run_deadline)
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.max_workers)
+                futures = []
+                for device in device_list:
+                    future: concurrent.futures.Future = pool.submit(
+                        self.execute_device, device, actions, run_deadline)
+                    future.sn = device.sn
+                    future.add_done_callback(self.execute_callback)
+                    futures.append(future)
+                self.wait(pool, futures, run_deadline)
+        finally:
+            self._buffer.close()
+            self._buffer = None
+        self.logger.info(f"inspection summary: {self.summary}")
         return self.result
 
+    def schedule(self, device_list: List[Device]) -> List[Device]:
+        """
+        按历史巡检耗时从长到短提交, 没有历史记录的设备排在最前, 避免慢设备最后才开始拖长整体耗时
+        """
+        try:
+            history = self.inspection_handler.durations([device.sn for device in device_list])
+        except Exception:
+            self.logger.error(f"load inspection durations failed, err: {traceback.format_exc()}")
+            return list(device_list)
+        return sorted(device_list, key=lambda device: history.get(device.sn, float("inf")), reverse=True)
+
+    def deadline(self, start: float, run_deadline: Optional[float]) -> Optional[float]:
+        deadlines = [d for d in (start + self.device_timeout if self.device_timeout else None, run_deadline)
+                     if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def wait(self, pool: concurrent.futures.Executor, futures: List[concurrent.futures.Future],
+             run_deadline: Optional[float] = None) -> None:
+        """
+        等待全部设备完成, 超过整体期限时取消未开始的设备, 不再等待执行中的设备
+        :param run_deadline: 整次巡检的期限(time.monotonic), 在run开始时确定, 不从调用wait时重新计时
+        """
+        timeout = None if run_deadline is None else max(0.0, run_deadline - time.monotonic())
+        _, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            self.logger.warning(f"{len(not_done)} devices exceeded the run deadline of {self.run_timeout}s")
+        pool.shutdown(wait=not not_done)
+
+    def execute_device(self, device: Device, actions: List[Any],
+                       run_deadline: Optional[float]) -> Tuple[List[Dict], float]:
+        start = time.monotonic()
+        res = self.inspection_handler.execute(
+            device, actions, self.config, self.action_handler, self.logger, self.deadline(start, run_deadline))
+        return res, time.monotonic() - start
+
+    async def run_async(self, device_list: List[Device], actions: List[Any],
+                        run_deadline: Optional[float] = None) -> None:
+        """
+        asyncio方式: 全局并发数之外, 再分别限制每个机房和每个厂商的并发数.
+        事件循环只负责排队和限流, 阻塞的execute在concurrency个线程的线程池中执行, 名额在线程执行完后才释放
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        idc_semaphores: Dict[Any, asyncio.Semaphore] = {}
+        vendor_semaphores: Dict[Any, asyncio.Semaphore] = {}
+        handler = self.inspection_handler
+
+        async def inspect(device: Device, executor: concurrent.futures.Executor):
+            async with contextlib.AsyncExitStack() as stack:
+                # 先占机房和厂商的名额, 等待时不占用全局名额
+                if self.idc_limit:
+                    idc = getattr(device, "idc", None)
+                    await stack.enter_async_context(
+                        idc_semaphores.setdefault(idc, asyncio.Semaphore(self.idc_limit)))
+                if self.vendor_limit:
+                    await stack.enter_async_context(
+                        vendor_semaphores.setdefault(device.vendor, asyncio.Semaphore(self.vendor_limit)))
+                await stack.enter_async_context(semaphore)
+                start = time.monotonic()
+                deadline = self.deadline(start, run_deadline)
+                task = asyncio.ensure_future(handler.execute_async(
+                    device, actions, self.config, self.action_handler, self.logger, executor, deadline))
+                res = []
+                try:
+                    try:
+                        res = await asyncio.wait_for(
+                            asyncio.shield(task), timeout=None if deadline is None else max(0.0, deadline - start))
+                    except asyncio.TimeoutError:
+                        # 线程池中的execute无法从外部中断, 要等它真正结束(execute自身会按期限停止)才释放名额,
+                        # 否则同一机房/厂商的并发会超过限制
+                        self.logger.warning(f"{device.hostname} exceeded its deadline, waiting for it to stop")
+                        res = await task
+                except Exception:
+                    self.logger.error(f"execute {device.hostname} failed, err: {traceback.format_exc()}")
+                # complete在落库缓冲满时会阻塞, 放到默认线程池中执行, 不阻塞事件循环
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.complete, device.sn, res, time.monotonic() - start)
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(inspect(device, executor) for device in device_list)),
+                timeout=None if run_deadline is None else max(0.0, run_deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.logger.warning(f"inspection exceeded the run deadline of {self.run_timeout}s")
+        finally:
+            executor.shutdown(wait=False)
+
+    def run_pipeline(self, device_list: List[Device], actions: List[Any],
+                     run_deadline: Optional[float] = None) -> None:
+        """
+        两阶段流水线: 采集线程只做SSH I/O, 原始回显经有界队列交给解析进程池批量解析和校验
+        """
+        raw_queue = queue.Queue(maxsize=self.queue_size)
+        parser = threading.Thread(target=self.parse_stage, args=(raw_queue,), daemon=True)
+        parser.start()
+        try:
+            pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            self.wait(pool, [pool.submit(self.collect_stage, device, actions, raw_queue, run_deadline)
+                             for device in device_list], run_deadline)
+        finally:
+            raw_queue.put(self._DONE)
+            parser.join()
+
+    def collect_stage(self, device: Device, actions: List[Any], raw_queue: queue.Queue,
+                      run_deadline: Optional[float] = None) -> None:
+        misses = []
+        hits = {}
+        start = time.monotonic()
+        try:
+            raw = self.inspection_handler.collect(
+                device, actions, self.config, self.action_handler, self.logger, self.deadline(start, run_deadline))
+            for idx, res in enumerate(raw):
+                # 在本进程查结果缓存, 只把未命中的回显交给解析进程
+                output_hash, cached = self.inspection_handler.lookup(res)
+                if cached is not None:
+                    hits[idx] = self.inspection_handler.make_row(res, output_hash, cached[0], cached[1], True)
+                    continue
+                # 解析进程只需要这几个字段, ORM对象不跨进程传递
+                misses.append((idx, {"action": ActionSpec.from_action(res["action"]), "output": res["output"]}))
+        except Exception:
+            self.logger.error(f"execute {device.hostname} failed, err: {traceback.format_exc()}")
+        self._pending[device.sn] = (hits, misses)
+        raw_queue.put((device.sn, [res for _, res in misses], time.monotonic() - start))
+
+    def parse_stage(self, raw_queue: queue.Queue) -> None:
+        handler_cls = type(self.inspection_handler)
+        # 限制在途的批次数, 解析跟不上时不再从队列取数据, 压力传回采集线程
+        inflight = threading.BoundedSemaphore(self.parse_workers * 2)
+
+        # 解析进程异常退出(BrokenProcessPool)后不再提交, 之后的批次在本线程解析
+        broken = threading.Event()
+
+        def finish(batch: List[Tuple[str, List[Dict], float]], results: List[Tuple[str, List[Dict], float, str]]):
+            for sn, res, duration, err in results:
+                if err:
+                    self.logger.error(f"analyze {sn} failed, err: {err}")
+                rows, misses = self._pending.pop(sn, ({}, []))
+                try:
+                    for (idx, raw), row in zip(misses, res):
+                        result_cache.put(ResultCache.key(raw["action"], row["output_hash"], handler_cls),
+                                         row["parse_result"], row["validation_result"])
+                        rows[idx] = row
+                except Exception:
+                    self.logger.error(f"merge {sn} failed, err: {traceback.format_exc()}")
+                self.complete(sn, [rows[idx] for idx in sorted(rows)], duration)
+            # 整批失败时, 没有结果的设备也要完成, 只保留命中缓存的部分
+            done = {sn for sn, _, _, _ in results}
+            for sn, _, duration in batch:
+                if sn not in done:
+                    rows, _ = self._pending.pop(sn, ({}, []))
+                    self.complete(sn, [rows[idx] for idx in sorted(rows)], duration)
+
+        def analyze(batch: List[Tuple[str, List[Dict], float]]):
+            try:
+                results = _analyze_batch(handler_cls, batch)
+            except Exception:
+                self.logger.error(f"analyze batch failed, err: {traceback.format_exc()}")
+                results = []
+            finish(batch, results)
+
+        def callback(future: concurrent.futures.Future):
+            inflight.release()
+            try:
+                results = future.result()
+            except Exception:
+                broken.set()
+                self.logger.error(f"parse process failed, analyze in thread, err: {traceback.format_exc()}")
+                analyze(future.batch)
+                return
+            finish(future.batch, results)
+
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as pool:
+            batch = []
+            while True:
+                item = raw_queue.get()
+                if item is not self._DONE:
+                    batch.append(item)
+                if batch and (len(batch) >= self.parse_batch_size or item is self._DONE):
+                    if broken.is_set():
+                        analyze(batch)
+                    else:
+                        inflight.acquire()
+                        try:
+                            future = pool.submit(_analyze_batch, handler_cls, batch)
+                        except Exception:
+                            inflight.release()
+                            broken.set()
+                            self.logger.error(f"submit parse batch failed, analyze in thread, "
+                                              f"err: {traceback.format_exc()}")
+                            analyze(batch)
+                        else:
+                            future.batch = batch
+                            future.add_done_callback(callback)
+                    batch = []
+                if item is self._DONE:
+                    break
+
     def execute_callback(self, future: concurrent.futures.Future):
-        self.result[future.sn] = future.result()
+        if future.cancelled():
+            self.logger.warning(f"{future.sn} cancelled, the run deadline was exceeded before it started")
+            return
+        res, duration = future.result()
+        self.complete(future.sn, res, duration)
+
+    def complete(self, sn: str, res: List[Dict], duration: Optional[float] = None) -> None:
+        """
+        单台设备完成: 统计缓存命中, 放入落库缓冲, 按需保留在内存中
+        :param duration: 设备巡检耗时, 随结果落库, 作为下次排序的依据
+        """
+        hits = sum(1 for row in res if row.pop("cache_hit", False))
+        with self._lock:
+            self.summary["devices"] = self.summary.get("devices", 0) + 1
+            self.summary["results"] = self.summary.get("results", 0) + len(res)
+            self.summary["cache_hits"] = self.summary.get("cache_hits", 0) + hits
+            if self.summary["results"]:
+                self.summary["hit_rate"] = self.summary["cache_hits"] / self.summary["results"]
+        if self.keep_result:
+            self.result[sn] = res
+        if self._buffer is not None:
+            self._buffer.put(self.serialize(sn, res, duration, self._devices.get(sn)))
+
+    @staticmethod
+    def serialize(sn: str, res: List[Dict], duration: Optional[float] = None,
+                  device: Optional[Device] = None, timestamp: Optional[datetime] = None) -> List[Dict]:
+        """
+        :param device: 设备, 用于汇总表的机房/厂商维度, 这两个字段不写入巡检记录
+        :param timestamp: 巡检时间, 默认为当前本地时间. 显式写入而不依赖数据库默认值(SQLite的默认值是UTC),
+            巡检记录、分表和每日汇总按同一个时间归属
+        """
+        timestamp = timestamp or datetime.now()
+        data = []
+        for content in res:
+            row = {"sn": sn, "duration": duration, "timestamp": timestamp,
+                   "idc": getattr(device, "idc", None), "vendor": getattr(device, "vendor", None)}
+            for k, v in content.items():
+                if isinstance(v, list) or isinstance(v, dict):
+                    v = json.dumps(v, ensure_ascii=False)
+                row[k] = v
+            data.append(row)
+        return data
 
     def save(self):
         data = []
         for sn, res in self.result.items():
-            for content in res:
-                for k in content:
-                    if isinstance(content[k], list) or isinstance(content[k], dict):
-                        content[k] = json.dumps(content[k], ensure_ascii=False)
-                data.append({"sn": sn, **content})
+            data.extend(self.serialize(sn, res, device=self._devices.get(sn)))
         self.inspection_handler.add(data)
 
 
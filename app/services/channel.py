@@ -0,0 +1,77 @@
+import re
+import time
+from typing import Any, List, Optional
+
+
+def get_channel(ssh: Any) -> Optional[Any]:
+    """
+    找到支持直接读写通道的连接对象(netmiko风格: find_prompt/write_channel/read_channel)
+    :param ssh: SSHExecutor 会话
+    :return: 连接对象, 不支持时返回None
+    """
+    for conn in (getattr(ssh, "conn", None), getattr(ssh, "connection", None), ssh):
+        if conn is not None and all(hasattr(conn, m) for m in ("find_prompt", "write_channel", "read_channel")):
+            return conn
+    return None
+
+
+def close_connection(ssh: Any) -> bool:
+    """
+    从其他线程中断会话: 关闭底层连接, 阻塞在读写上的调用随即出错返回
+    :param ssh: SSHExecutor 会话
+    :return: 是否找到了可以关闭的连接
+    """
+    for conn in (getattr(ssh, "conn", None), getattr(ssh, "connection", None), ssh):
+        if conn is None:
+            continue
+        for name in ("disconnect", "close"):
+            method = getattr(conn, name, None)
+            if callable(method):
+                try:
+                    method()
+                except Exception:
+                    pass
+                return True
+    return False
+
+
+def split_outputs(buffer: str, prompt: str, count: int) -> List[str]:
+    """
+    按行首的提示符切分连续执行多条命令的回显, 每段第一行是命令本身的回显
+    :param buffer: 通道中读到的全部内容
+    :param prompt: 设备提示符
+    :param count: 命令条数
+    :return: List[str] 每条命令的回显
+    """
+    parts = re.split(r"(?m)^%s" % re.escape(prompt), buffer.replace("\r\n", "\n"))
+    outputs = []
+    for part in parts[:count]:
+        lines = part.split("\n", 1)
+        outputs.append(lines[1].strip("\n") if len(lines) > 1 else "")
+    outputs.extend([""] * (count - len(outputs)))
+    return outputs
+
+
+def send_batch(channel: Any, cmds: List[str], timeout: float = 60.0, interval: float = 0.05) -> List[str]:
+    """
+    一次性写入多条命令, 不必每条都等一个往返, 读到足够多的提示符后再切分回显
+    :param channel: get_channel返回的连接对象
+    :param cmds: List[str] 命令, 只应包含show类命令
+    :param timeout: 等待全部回显的秒数
+    :param interval: 读通道的间隔秒数
+    :return: List[str] 每条命令的回显
+    """
+    prompt = channel.find_prompt()
+    pattern = re.compile(r"(?m)^%s" % re.escape(prompt))
+    channel.write_channel("".join("%s\n" % cmd for cmd in cmds))
+    buffer = ""
+    deadline = time.monotonic() + timeout
+    while len(pattern.findall(buffer)) < len(cmds):
+        if time.monotonic() > deadline:
+            raise TimeoutError("read %d of %d prompts before timeout" % (len(pattern.findall(buffer)), len(cmds)))
+        chunk = channel.read_channel()
+        if chunk:
+            buffer += chunk
+        else:
+            time.sleep(interval)
+    return split_outputs(buffer, prompt, len(cmds))
@@ -0,0 +1,115 @@
+import atexit
+import contextlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, ContextManager, Dict, Iterator, Optional, Tuple
+
+
+class SSHConnectionPool:
+    """
+    按设备缓存已登录的SSH会话, 连续的巡检复用会话, 省去建连/认证/enable的开销.
+    空闲超过idle_ttl或空闲会话数超过max_size(按最近使用淘汰)时关闭
+    """
+
+    def __init__(self, max_size: int = 1024, idle_ttl: float = 300,
+                 health_check: Optional[Callable[[Any], bool]] = None) -> None:
+        """
+        :param max_size: 最多保留的空闲会话数
+        :param idle_ttl: 空闲会话的存活秒数
+        :param health_check: 取出会话时的检查函数, 默认调用会话的is_alive方法(如果有)
+        """
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.health_check = health_check or self._is_alive
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        # (key, 序号) -> (上下文管理器, 会话, 最后使用时间), 按最后使用时间排序
+        self._idle: "OrderedDict[Tuple[Any, int], Tuple[ContextManager, Any, float]]" = OrderedDict()
+
+    @staticmethod
+    def _is_alive(conn: Any) -> bool:
+        is_alive = getattr(conn, "is_alive", None)
+        return is_alive() if callable(is_alive) else True
+
+    @staticmethod
+    def _close(cm: ContextManager) -> None:
+        try:
+            cm.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def _prune(self, now: float) -> list:
+        """
+        取出过期和超量的空闲会话, 调用方在锁外关闭
+        """
+        expired = []
+        while self._idle:
+            key, (cm, conn, last_used) = next(iter(self._idle.items()))
+            if now - last_used <= self.idle_ttl and len(self._idle) <= self.max_size:
+                break
+            del self._idle[key]
+            expired.append(cm)
+        return expired
+
+    def _checkout(self, key: Any) -> Optional[Tuple[ContextManager, Any]]:
+        with self._lock:
+            expired = self._prune(time.monotonic())
+            found = None
+            for idle_key in reversed(self._idle):
+                if idle_key[0] == key:
+                    found = idle_key
+                    break
+            entry = self._idle.pop(found) if found else None
+        for cm in expired:
+            self._close(cm)
+        if entry is None:
+            return None
+        cm, conn, _ = entry
+        try:
+            if self.health_check(conn):
+                return cm, conn
+        except Exception:
+            pass
+        self._close(cm)
+        return None
+
+    def _checkin(self, key: Any, cm: ContextManager, conn: Any) -> None:
+        with self._lock:
+            self._idle[(key, next(self._counter))] = (cm, conn, time.monotonic())
+            expired = self._prune(time.monotonic())
+        for cm in expired:
+            self._close(cm)
+
+    @contextlib.contextmanager
+    def session(self, key: Any, factory: Callable[[], ContextManager]) -> Iterator[Any]:
+        """
+        :param key: 设备标识, 一般为sn
+        :param factory: 没有可用会话时调用, 返回未进入的会话上下文管理器(如SSHExecutor)
+        :return: 已登录的会话; 使用过程中抛出异常的会话直接关闭, 不放回池中
+        """
+        entry = self._checkout(key)
+        if entry is None:
+            cm = factory()
+            entry = cm, cm.__enter__()
+        cm, conn = entry
+        try:
+            yield conn
+        except BaseException:
+            self._close(cm)
+            raise
+        self._checkin(key, cm, conn)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, OrderedDict()
+        for cm, _, _ in idle.values():
+            self._close(cm)
+
+    def stats(self) -> Dict[str, int]:
+        return {"idle": len(self._idle)}
+
+
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
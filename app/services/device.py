@@ -1,5 +1,34 @@
 import abc
-from typing import List, Dict, Optional
+import csv
+import functools
+import itertools
+import json
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Set, TextIO, Tuple
+
+import pymysql
+from pymysql.cursors import DictCursor, SSDictCursor
+
+from app.utils.db_pool import ConnectionPool
+from app.utils.query import build_select, build_upsert
+
+
+def iter_csv(fp: TextIO) -> Iterator[Dict]:
+    """
+    逐行读取带表头的CSV设备清单
+    """
+    yield from csv.DictReader(fp)
+
+
+def iter_ndjson(fp: TextIO) -> Iterator[Dict]:
+    """
+    逐行读取NDJSON设备清单, 跳过空行
+    """
+    for line in fp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
 
 
 class DeviceHandler(abc.ABC):
@@ -25,45 +54,113 @@ class DeviceHandler(abc.ABC):
 
 
 class DeviceDBHandler(DeviceHandler):
-    def __init__(self, user: str, password: str, host: str, database: str, port: int = 3306) -> None:
-        self.conn = pymysql.connect(user=user, password=password, host=host, port=port, database=database,
-                                    cursorclass=DictCursor)
-        self.conn: pymysql.connections.Connection
+    from_sql = "devices join device_detail on devices.sn = device_detail.sn"
+    # 字段名 -> SQL中的列, 只有这里的字段可以查询和筛选
+    columns = {
+        "sn": "devices.sn", "ip": "devices.ip", "hostname": "devices.hostname", "idc": "devices.idc",
+        "vendor": "devices.vendor", "model": "devices.model", "role": "devices.role",
+        "hardware": "device_detail.hardware", "channel": "device_detail.channel",
+        "device_type": "device_detail.device_type", "updated_at": "devices.updated_at",
+    }
+    device_columns = ("sn", "ip", "hostname", "idc", "vendor", "model", "role")
+    device_detail_columns = ("sn", "ipv6", "console_ip", "row", "column", "last_start", "runtime",
+                             "image_version", "over_warrant", "warrant_time")
+    default_columns = ["sn", "ip", "hostname", "vendor", "model", "hardware", "channel", "device_type"]
+
+    def __init__(self, user: str, password: str, host: str, database: str, port: int = 3306,
+                 pool_size: int = 10, max_lifetime: float = 3600, creator: Optional[Callable[[], Any]] = None,
+                 placeholder: str = "%s", stream_cursor: Optional[type] = None, dialect: str = "mysql") -> None:
+        """
+        :param pool_size: 连接池大小, 巡检线程并发查询设备时各自借用连接
+        :param max_lifetime: 连接最长存活秒数
+        :param creator: 创建连接的函数, 默认连接MySQL, 测试时可以替换为其他DB-API驱动
+        :param placeholder: 驱动的参数占位符, pymysql为%s, sqlite3为?
+        :param stream_cursor: 流式查询使用的游标类, 默认连接MySQL时为SSDictCursor
+        :param dialect: 批量导入的upsert语法 [mysql|sqlite]
+        """
+        custom = creator is not None
+        creator = creator or functools.partial(
+            pymysql.connect, user=user, password=password, host=host, port=port, database=database,
+            cursorclass=DictCursor)
+        self.pool = ConnectionPool(creator, max_size=pool_size, max_lifetime=max_lifetime)
+        self.placeholder = placeholder
+        self.dialect = dialect
+        self.stream_cursor = stream_cursor if stream_cursor is not None or custom else SSDictCursor
 
-    def get_conn(self) -> Cursor:
-        if self.conn is None:
-            raise Exception("mysql is lost connection")
-        return self.conn.cursor()
+    def get_conn(self):
+        """
+        :return: 上下文管理器, 借出一个连接并在退出时归还
+        """
+        return self.pool.connection()
 
     def close_db(self):
-        self.conn.close()
+        self.pool.close_all()
 
     def add(self, data: List[Dict]) -> None:
-        cursor = self.get_conn()
-        device_sql = "insert into devices (sn, ip, hostname, idc, vendor, model, role) values (%s, %s, %s, %s, %s, %s, %s);"
-        device_detail_sql = "insert into device_detail values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-        device_data = []
-        device_detail_data = []
-        for item in data:
-            device_data.append([
-                item.get("sn", ""), item.get("ip", ""), item.get("hostname", ""), item.get("idc", ""),
-                item.get("vendor", ""), item.get("model", ""), item.get("role", "")
-            ])
-            device_detail_data.append([
-                item.get("sn", ""), item.get("ipv6", ""), item.get("console_ip", ""), item.get("row", ""),
+        report = self.import_rows(data, stop_on_error=True)
+        if report["errors"]:
+            raise Exception("db insert failed, error: %s" % report["errors"][0]["error"])
+
+    @staticmethod
+    def _device_values(item: Dict) -> List[Any]:
+        return [item.get("sn", ""), item.get("ip", ""), item.get("hostname", ""), item.get("idc", ""),
+                item.get("vendor", ""), item.get("model", ""), item.get("role", "")]
+
+    @staticmethod
+    def _device_detail_values(item: Dict) -> List[Any]:
+        # CSV中的空值为"", 过保信息按NULL写入
+        over_warrant, warrant_time = item.get("over_warrant"), item.get("warrant_time")
+        return [item.get("sn", ""), item.get("ipv6", ""), item.get("console_ip", ""), item.get("row", ""),
                 item.get("column", ""), item.get("last_start", ""), item.get("runtime", ""),
                 item.get("image_version", ""),
-                item.get("over_warrant"), item.get("warrant_time")
-            ])
-        try:
-            cursor.executemany(device_sql, device_data)
-            cursor.executemany(device_detail_sql, device_detail_data)
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise Exception("db insert failed, error: %s" % str(e))
-        finally:
-            cursor.close()
+                None if over_warrant == "" else over_warrant, None if warrant_time == "" else warrant_time]
+
+    def _upsert(self, cursor: Any, table: str, columns: Tuple[str, ...], rows: List[List[Any]]) -> None:
+        sql = build_upsert(table, columns, len(rows), ("sn",), self.dialect, self.placeholder)
+        cursor.execute(sql, [value for row in rows for value in row])
+
+    def import_rows(self, rows: Iterable[Dict], batch_size: int = 1000,
+                    progress: Optional[Callable[[Dict], None]] = None, stop_on_error: bool = False) -> Dict:
+        """
+        分批导入设备, 每批一条多行插入, sn已存在时更新, 每批单独提交
+        :param rows: Iterable[Dict] 设备信息, 可以是iter_csv/iter_ndjson返回的生成器
+        :param batch_size: 每批行数
+        :param progress: 每批完成后回调, 参数为该批的结果 {"chunk", "start", "count", "error", "imported", "failed"}
+        :param stop_on_error: 遇到失败的批次时停止, 之前的批次已提交
+        :return: Dict {"total": 读取行数, "imported": 成功行数, "failed": 失败行数, "errors": 失败批次}
+        """
+        report = {"total": 0, "imported": 0, "failed": 0, "errors": []}
+        rows = iter(rows)
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                for chunk_no in itertools.count():
+                    chunk = list(itertools.islice(rows, batch_size))
+                    if not chunk:
+                        break
+                    start = report["total"]
+                    report["total"] += len(chunk)
+                    error = None
+                    try:
+                        self._upsert(cursor, "devices", self.device_columns,
+                                     [self._device_values(item) for item in chunk])
+                        self._upsert(cursor, "device_detail", self.device_detail_columns,
+                                     [self._device_detail_values(item) for item in chunk])
+                        conn.commit()
+                        report["imported"] += len(chunk)
+                    except Exception as e:
+                        conn.rollback()
+                        error = str(e)
+                        report["failed"] += len(chunk)
+                        report["errors"].append({"chunk": chunk_no, "start": start, "count": len(chunk), "error": error})
+                    if progress is not None:
+                        progress({"chunk": chunk_no, "start": start, "count": len(chunk), "error": error,
+                                  "imported": report["imported"], "failed": report["failed"]})
+                    if error is not None and stop_on_error:
+                        break
+            finally:
+                cursor.close()
+        return report
 
     def delete(self, data: Dict) -> None:
         pass
@@ -71,22 +168,200 @@ class DeviceDBHandler(DeviceHandler):
     def update(self, data: Dict) -> None:
         pass
 
-    def get(self, condition: Optional[Dict] = None) -> List[Device]:
-        cursor = self.get_conn()
-        sql = "select ip, hostname, vendor, model, hardware, channel, device_type from devices " \
-              "join device_detail on devices.sn = device_detail.sn"
-        where_str = []
-        if condition is not None:
-            for k, v in condition.items():
-                if isinstance(v, int):
-                    where_str.append("%s=%d" % (k, v))
-                else:
-                    where_str.append("%s='%s'" % (k, v))
-        if len(where_str) > 0:
-            sql += (" where %s" % ",".join(where_str))
-        cursor.execute(sql)
-        result = cursor.fetchall()
+    def query(self, condition: Optional[Dict] = None, columns: Optional[List[str]] = None,
+              order_by: Optional[str] = None) -> Tuple[str, List[Any]]:
+        """
+        :param condition: Dict[Str, Any] 筛选条件, 支持等值/IN列表/范围, 见app.utils.query.build_where
+        :param columns: 需要返回的字段, 默认与原查询相同
+        :param order_by: 排序字段
+        :return: (SQL, 参数)
+        """
+        return build_select(self.from_sql, self.columns, condition, columns or self.default_columns,
+                            self.placeholder, order_by)
+
+    def get(self, condition: Optional[Dict] = None, columns: Optional[List[str]] = None) -> List[Device]:
+        sql, params = self.query(condition, columns)
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                result = cursor.fetchall()
+                names = [d[0] for d in cursor.description]
+            finally:
+                cursor.close()
         devices = []
         for item in result:
-            devices.append(Device().to_model(**item))
+            devices.append(Device().to_model(**self._row(names, item)))
+        return devices
+
+    def iter_batches(self, condition: Optional[Dict] = None, columns: Optional[List[str]] = None,
+                     batch_size: int = 1000) -> Iterator[List[Device]]:
+        """
+        流式读取设备, 每次返回一批, 不必先把整个devices/device_detail的连接结果读进内存
+        MySQL使用服务端游标(SSDictCursor), 迭代结束前一直占用连接池中的一个连接
+        :param batch_size: 每批设备数
+        """
+        for rows in self.iter_rows(condition, columns, batch_size):
+            yield [Device().to_model(**item) for item in rows]
+
+    def iter_rows(self, condition: Optional[Dict] = None, columns: Optional[List[str]] = None,
+                  batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """
+        同iter_batches, 返回原始的行
+        :return: Iterator[List[Dict]]
+        """
+        sql, params = self.query(condition, columns, order_by="sn")
+        with self.get_conn() as conn:
+            cursor = conn.cursor(self.stream_cursor) if self.stream_cursor else conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                names = [d[0] for d in cursor.description]
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [self._row(names, item) for item in rows]
+            finally:
+                cursor.close()
+
+    def get_by_sn(self, sns: List[str], batch_size: int = 1000) -> List[Device]:
+        """
+        按资产号批量查询, IN列表按batch_size分段避免SQL过长
+        """
+        sns = list(sns)
+        devices = []
+        for i in range(0, len(sns), batch_size):
+            devices.extend(self.get({"sn": sns[i:i + batch_size]}, list(self.columns)))
         return devices
+
+    @staticmethod
+    def _row(names: List[str], item: Any) -> Dict:
+        # DictCursor返回dict, 其他驱动的行按列名转换
+        if isinstance(item, dict):
+            return item
+        return dict(zip(names, item))
+
+
+class DeviceInventory(DeviceHandler):
+    """
+    本地设备清单缓存: 按updated_at水位线增量同步, 在内存中按sn/ip/hostname/idc建立索引
+    增量同步发现不了删除的设备和只修改了device_detail的设备, 由定期全量同步兜底
+    """
+    index_fields = ("ip", "hostname", "idc")
+
+    def __init__(self, handler: DeviceDBHandler, interval: float = 60, full_interval: float = 3600,
+                 batch_size: int = 1000) -> None:
+        """
+        :param handler: 数据来源
+        :param interval: 距上次同步超过该秒数时, 查询前先增量同步
+        :param full_interval: 全量同步的间隔秒数
+        :param batch_size: 同步时每批读取的行数
+        """
+        self.handler = handler
+        self.interval = interval
+        self.full_interval = full_interval
+        self.batch_size = batch_size
+        self.watermark = None
+        self._devices: Dict[str, Device] = {}
+        # 字段 -> 值 -> sn集合
+        self._index: Dict[str, Dict[Any, Set[str]]] = {field: {} for field in self.index_fields}
+        self._synced_at: Optional[float] = None
+        self._full_synced_at: Optional[float] = None
+        self._lock = threading.RLock()
+
+    def _put(self, device: Device) -> None:
+        self._remove(device.sn)
+        self._devices[device.sn] = device
+        for field in self.index_fields:
+            self._index[field].setdefault(getattr(device, field, None), set()).add(device.sn)
+
+    def _remove(self, sn: str) -> None:
+        device = self._devices.pop(sn, None)
+        if device is None:
+            return
+        for field in self.index_fields:
+            value = getattr(device, field, None)
+            sns = self._index[field].get(value)
+            if sns is not None:
+                sns.discard(sn)
+                if not sns:
+                    del self._index[field][value]
+
+    def sync(self, full: bool = False) -> int:
+        """
+        读取updated_at不早于水位线的设备并更新索引. 用>=而不是>, 同一秒内后写入的行不会漏掉
+        :param full: 全量同步, 同时移除已删除的设备
+        :return: int 本次读取的行数
+        """
+        with self._lock:
+            now = time.monotonic()
+            full = full or self.watermark is None or self._full_synced_at is None \
+                or now - self._full_synced_at > self.full_interval
+            condition = None if full else {"updated_at": {"gte": self.watermark}}
+            watermark = None if full else self.watermark
+            seen = set()
+            for rows in self.handler.iter_rows(condition, list(self.handler.columns), self.batch_size):
+                for item in rows:
+                    self._put(Device().to_model(**item))
+                    seen.add(item["sn"])
+                    updated_at = item.get("updated_at")
+                    if updated_at is not None and (watermark is None or updated_at > watermark):
+                        watermark = updated_at
+            if full:
+                for sn in set(self._devices) - seen:
+                    self._remove(sn)
+                self._full_synced_at = now
+            self.watermark = watermark
+            self._synced_at = now
+            return len(seen)
+
+    def refresh(self) -> None:
+        """
+        距上次同步超过interval时同步一次
+        """
+        if self._synced_at is None or time.monotonic() - self._synced_at > self.interval:
+            self.sync()
+
+    def add(self, data: List[Dict]) -> None:
+        self.handler.add(data)
+        self.sync()
+
+    def delete(self, data: Dict) -> None:
+        self.handler.delete(data)
+        self.sync(full=True)
+
+    def update(self, data: Dict) -> None:
+        self.handler.update(data)
+        self.sync()
+
+    def get(self, condition: Optional[Dict] = None) -> List[Device]:
+        """
+        只包含sn/ip/hostname/idc的等值或IN列表条件从内存返回, 其他条件查询数据库
+        """
+        condition = condition or {}
+        for k, v in condition.items():
+            if (k != "sn" and k not in self.index_fields) or v is None or isinstance(v, dict):
+                return self.handler.get(condition)
+        self.refresh()
+        with self._lock:
+            sns = None
+            for k, v in condition.items():
+                values = v if isinstance(v, (list, tuple, set, frozenset)) else [v]
+                if k == "sn":
+                    matched = {sn for sn in values if sn in self._devices}
+                else:
+                    matched = set()
+                    for value in values:
+                        matched |= self._index[k].get(value, set())
+                sns = matched if sns is None else sns & matched
+            if sns is None:
+                return list(self._devices.values())
+            return [self._devices[sn] for sn in sorted(sns)]
+
+    def get_by_sn(self, sns: List[str]) -> List[Device]:
+        self.refresh()
+        with self._lock:
+            return [self._devices[sn] for sn in sns if sn in self._devices]
+
+    def __len__(self) -> int:
+        return len(self._devices)
@@ -0,0 +1,221 @@
+import functools
+import hashlib
+import inspect
+import io
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+try:
+    import textfsm
+except ImportError:  # pragma: no cover
+    textfsm = None
+
+
+class ActionSpec(namedtuple("ActionSpec", ["id", "name", "parse_type", "parse_content"])):
+    """
+    解析所需的动作字段, 可以跨进程传递
+    """
+
+    @classmethod
+    def from_action(cls, action: Any) -> "ActionSpec":
+        return cls(action.id, action.name, action.parse_type, action.parse_content)
+
+
+class CompiledParser:
+    """
+    编译好的解析器, regexp编译为Pattern, textfsm编译为状态机.
+    巡检时SSHExecutor只负责取回显(parse=False), 解析统一由这里完成, 结果原样交给与动作同名的校验方法,
+    校验方法按下面parse的返回值编写
+    """
+
+    def __init__(self, parse_type: Optional[str], parse_content: Optional[str]) -> None:
+        """
+        :param parse_type: 解析类型[regexp|textfsm]
+        :param parse_content: 解析内容
+        """
+        self.parse_type = parse_type
+        # TextFSM对象带状态, 同一个解析器被多个线程复用时需要串行
+        self._lock = threading.Lock()
+        self._pattern = None
+        self._fsm = None
+        if not parse_content:
+            return
+        if parse_type == "regexp":
+            self._pattern = re.compile(parse_content, re.M)
+        elif parse_type == "textfsm":
+            if textfsm is None:
+                raise Exception("textfsm is not installed")
+            self._fsm = textfsm.TextFSM(io.StringIO(parse_content))
+
+    def parse(self, output: str) -> Any:
+        """
+        :param output: 设备回显
+        :return: 解析结果, 按解析类型区分:
+            regexp有命名分组: List[Dict[组名, str|None]] 每次匹配一个字典(多行模式re.M)
+            regexp只有匿名分组: List[List[str|None]] 每次匹配一个列表
+            regexp没有分组: List[str] 每次匹配的整段文本
+            textfsm: List[Dict[字段名, str|List[str]]] 每条记录一个字典, List类型的字段为列表
+            没有解析内容或不支持的解析类型: str 原样返回回显
+        """
+        if self._pattern is not None:
+            if self._pattern.groupindex:
+                return [m.groupdict() for m in self._pattern.finditer(output)]
+            return [list(m.groups()) or m.group(0) for m in self._pattern.finditer(output)]
+        if self._fsm is not None:
+            with self._lock:
+                self._fsm.Reset()
+                rows = self._fsm.ParseText(output)
+                return [dict(zip(self._fsm.header, row)) for row in rows]
+        return output
+
+
+class ParserCache:
+    """
+    进程级的解析器缓存, 以(动作id, 解析内容摘要)为key, LRU淘汰
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._parsers: "OrderedDict[Tuple[Any, str], CompiledParser]" = OrderedDict()
+
+    @staticmethod
+    def digest(parse_type: Optional[str], parse_content: Optional[str]) -> str:
+        return hashlib.sha1(("%s\0%s" % (parse_type or "", parse_content or "")).encode("utf-8")).hexdigest()
+
+    def get(self, action: Any) -> CompiledParser:
+        """
+        :param action: Action 动作, 需要有id, parse_type, parse_content属性
+        :return: CompiledParser
+        """
+        key = (action.id, self.digest(action.parse_type, action.parse_content))
+        with self._lock:
+            parser = self._parsers.get(key)
+            if parser is not None:
+                self._parsers.move_to_end(key)
+                self.hits += 1
+                return parser
+            self.misses += 1
+        # 编译放在锁外, 并发编译同一个模板时以后写入的为准
+        parser = CompiledParser(action.parse_type, action.parse_content)
+        with self._lock:
+            self._parsers[key] = parser
+            self._parsers.move_to_end(key)
+            while len(self._parsers) > self.maxsize:
+                self._parsers.popitem(last=False)
+        return parser
+
+    def parse(self, action: Any, output: str) -> Any:
+        """
+        :param action: Action 动作
+        :param output: 设备回显
+        :return: 解析结果
+        """
+        return self.get(action).parse(output)
+
+    def invalidate(self, action_ids: Optional[Iterable[Any]] = None) -> None:
+        """
+        :param action_ids: 失效的动作id, 为空时清空全部
+        """
+        with self._lock:
+            if action_ids is None:
+                self._parsers.clear()
+                return
+            action_ids = set(action_ids)
+            for key in [key for key in self._parsers if key[0] in action_ids]:
+                del self._parsers[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._parsers), "hits": self.hits, "misses": self.misses}
+
+
+parser_cache = ParserCache()
+
+
+class ResultCache:
+    """
+    (动作id, 解析内容及校验逻辑的摘要, 回显摘要) -> (解析结果, 校验结果) 的缓存, 回显没有变化时跳过解析和校验.
+    校验方法的代码变化后摘要随之变化, 不会再命中旧的校验结果.
+    新增的记录标记为dirty, 由落库线程取走持久化
+    """
+
+    def __init__(self, maxsize: int = 100000) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._results: "OrderedDict[Tuple[Any, str, str], Tuple[Any, Any]]" = OrderedDict()
+        self._dirty: "OrderedDict[Tuple[Any, str, str], Tuple[Any, Any]]" = OrderedDict()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def validation_version(handler_cls: type, name: str) -> str:
+        """
+        校验方法的版本, 取其源码的摘要, 拿不到源码时取字节码的摘要
+        :param handler_cls: InspectionHandler的子类, 校验方法是其上与动作同名的方法
+        :param name: 动作名
+        :return: str 没有校验方法时为空
+        """
+        func = getattr(handler_cls, name, None)
+        if func is None:
+            return ""
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            code = getattr(func, "__code__", None)
+            source = repr((code.co_code, code.co_consts)) if code is not None else repr(func)
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def key(cls, action: Any, output_hash: str, handler_cls: type) -> Tuple[Any, str, str]:
+        """
+        :param action: Action|ActionSpec 动作
+        :param output_hash: 回显摘要
+        :param handler_cls: 执行校验的InspectionHandler子类
+        """
+        parse_digest = ParserCache.digest(action.parse_type, action.parse_content)
+        version = cls.validation_version(handler_cls, action.name)
+        if version:
+            parse_digest = hashlib.sha1(("%s\0%s" % (parse_digest, version)).encode("utf-8")).hexdigest()
+        return action.id, parse_digest, output_hash
+
+    def get(self, key: Tuple[Any, str, str]) -> Optional[Tuple[Any, Any]]:
+        with self._lock:
+            value = self._results.get(key)
+            if value is not None:
+                self._results.move_to_end(key)
+            return value
+
+    def put(self, key: Tuple[Any, str, str], parse_result: Any, validation_result: Any, dirty: bool = True) -> None:
+        with self._lock:
+            self._results[key] = (parse_result, validation_result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+            if dirty:
+                self._dirty[key] = (parse_result, validation_result)
+                while len(self._dirty) > self.maxsize:
+                    self._dirty.popitem(last=False)
+
+    def restore(self, entries: Dict[Tuple[Any, str, str], Tuple[Any, Any]]) -> None:
+        """
+        落库失败时把drain取走的记录重新标记为dirty, 期间又写入的同一个key以新值为准
+        """
+        with self._lock:
+            for key, value in entries.items():
+                self._dirty.setdefault(key, value)
+            while len(self._dirty) > self.maxsize:
+                self._dirty.popitem(last=False)
+
+    def drain(self) -> Dict[Tuple[Any, str, str], Tuple[Any, Any]]:
+        """
+        :return: 上次取走之后新增的记录
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, OrderedDict()
+        return dirty
+
+
+result_cache = ResultCache()
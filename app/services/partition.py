@@ -0,0 +1,266 @@
+import re
+import threading
+from datetime import date, datetime, time, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import MetaData, Table, and_, exists, func, inspect, select, text, union_all
+from sqlalchemy.orm import scoped_session
+
+from app.models.inspection import Inspection, InspectionOutput
+
+# 无引用的回显至少保留这么久才清理, 写入方复用回显后到提交之前, 回显不会被删除
+OUTPUT_GC_GRACE = timedelta(days=1)
+
+_metadata = MetaData()
+_lock = threading.Lock()
+# 已确认存在的按月分表, (数据库地址, 表名)
+_created = set()
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    year, index = divmod(month.month - 1 + n, 12)
+    return date(month.year + year, index + 1, 1)
+
+
+def partition_table(month: date) -> Table:
+    """
+    :param month: 月份的第一天
+    :return: Table 与inspection结构相同的inspection_YYYYMM表, 索引名带上表名避免在SQLite中重名
+    """
+    name = "inspection_%s" % month.strftime("%Y%m")
+    with _lock:
+        table = _metadata.tables.get(name)
+        if table is None:
+            table = Inspection.__table__.to_metadata(_metadata, name=name)
+            for index in table.indexes:
+                if index.name and not index.name.startswith("ix_%s_" % name):
+                    index.name = index.name.replace("ix_inspection_", "ix_%s_" % name, 1)
+        return table
+
+
+class InspectionPartitions:
+    """
+    按月分区存储巡检记录
+        MySQL: inspection表按timestamp做RANGE分区(每月一个), 范围查询由MySQL裁剪分区, 过期数据按分区删除
+        SQLite等: 每月一张inspection_YYYYMM表, 范围查询只UNION覆盖该时间段的表, 过期数据按表删除
+    未开启分区时所有数据都在inspection表中, 分区前写入的旧数据也始终参与查询
+    """
+    table_pattern = re.compile(r"^inspection_(\d{4})(\d{2})$")
+    partition_pattern = re.compile(r"^p(\d{4})(\d{2})$")
+
+    def __init__(self, db_handler: scoped_session, partitioned: bool = False) -> None:
+        """
+        :param partitioned: 是否开启分区存储
+        """
+        self.db_handler = db_handler
+        self.partitioned = partitioned
+
+    @property
+    def dialect(self) -> str:
+        return self.db_handler.get_bind().dialect.name
+
+    @property
+    def monthly(self) -> bool:
+        """
+        是否按月分表, MySQL使用原生分区不需要分表
+        """
+        return self.partitioned and self.dialect != "mysql"
+
+    def table(self, month: date) -> Table:
+        """
+        取得某月的分表, 不存在时创建
+        """
+        table = partition_table(month)
+        key = (str(self.db_handler.get_bind().url), table.name)
+        if key not in _created:
+            table.create(self.db_handler.connection(), checkfirst=True)
+            _created.add(key)
+        return table
+
+    def month_tables(self) -> Dict[date, Table]:
+        """
+        :return: Dict[月份, 分表] 数据库中已存在的按月分表
+        """
+        result = {}
+        for name in inspect(self.db_handler.connection()).get_table_names():
+            match = self.table_pattern.match(name)
+            if match:
+                month = date(int(match.group(1)), int(match.group(2)), 1)
+                result[month] = partition_table(month)
+        return result
+
+    def tables(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Table]:
+        """
+        裁剪分区: 只返回与[start, end)有交集的表, inspection表总是包含在内
+        """
+        result = [Inspection.__table__]
+        if not self.monthly:
+            return result
+        for month, table in sorted(self.month_tables().items()):
+            if start is not None and datetime.combine(add_months(month, 1), time()) <= start:
+                continue
+            if end is not None and datetime.combine(month, time()) >= end:
+                continue
+            result.append(table)
+        return result
+
+    def window(self, columns: List[str], start: Optional[datetime] = None, end: Optional[datetime] = None,
+               where: Optional[Callable[[Table], Any]] = None) -> Any:
+        """
+        时间范围查询的数据源, 条件在每个分表内分别执行, 可以用到各自的(timestamp, sn)索引
+        :param columns: 需要的字段
+        :param start: 用于裁剪分区的开始时间
+        :param end: 用于裁剪分区的结束时间
+        :param where: 根据表生成筛选条件的函数, 需要包含时间条件
+        :return: 子查询, 字段通过.c访问
+        """
+        selects = []
+        for table in self.tables(start, end):
+            stmt = select(*[table.c[name] for name in columns])
+            if where is not None:
+                stmt = stmt.where(where(table))
+            selects.append(stmt)
+        stmt = selects[0] if len(selects) == 1 else union_all(*selects)
+        return stmt.subquery("inspection_window")
+
+    def insert(self, rows: List[Dict]) -> None:
+        """
+        按巡检时间写入对应月份的分表, 没有timestamp的记录使用当前时间
+        """
+        names = [c.name for c in Inspection.__table__.columns if c.name != "id"]
+        now = datetime.now()
+        groups: Dict[date, List[Dict]] = {}
+        for row in rows:
+            item = {name: row.get(name) for name in names}
+            item["timestamp"] = item["timestamp"] or now
+            groups.setdefault(month_start(item["timestamp"]), []).append(item)
+        for month, items in groups.items():
+            self.db_handler.execute(self.table(month).insert(), items)
+
+    def mysql_partitions(self) -> Dict[str, Optional[date]]:
+        """
+        :return: Dict[分区名, 月份] 不是按月命名的分区(如pmax)月份为None
+        """
+        rows = self.db_handler.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name AND PARTITION_NAME IS NOT NULL"),
+            {"name": Inspection.__tablename__})
+        result = {}
+        for name, in rows:
+            match = self.partition_pattern.match(name)
+            result[name] = date(int(match.group(1)), int(match.group(2)), 1) if match else None
+        return result
+
+    @staticmethod
+    def _partition_sql(month: date) -> str:
+        return "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % (
+            month.strftime("%Y%m"), add_months(month, 1).isoformat())
+
+    def ensure_partitions(self, months_ahead: int = 3) -> List[str]:
+        """
+        MySQL: 预先建好当前及之后months_ahead个月的分区. 首次执行时把inspection改为分区表,
+        分区键必须包含在主键中, 主键改为(id, timestamp), 之前的数据全部放入上个月的分区
+        :return: List[str] 新建的分区
+        """
+        if not self.partitioned or self.dialect != "mysql":
+            return []
+        current = month_start(date.today())
+        wanted = [add_months(current, n) for n in range(-1, months_ahead + 1)]
+        existing = self.mysql_partitions()
+        table = Inspection.__tablename__
+        if not existing:
+            parts = ["PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % (
+                wanted[0].strftime("%Y%m"), current.isoformat())]
+            parts += [self._partition_sql(month) for month in wanted[1:]]
+            parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+            self.db_handler.execute(text("ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)" % table))
+            self.db_handler.execute(text("ALTER TABLE %s PARTITION BY RANGE (TO_DAYS(timestamp)) (%s)" % (
+                table, ", ".join(parts))))
+            return ["p%s" % month.strftime("%Y%m") for month in wanted]
+        latest = max(month for month in existing.values() if month is not None)
+        missing = [month for month in wanted if month > latest]
+        if missing:
+            parts = [self._partition_sql(month) for month in missing]
+            parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+            self.db_handler.execute(text("ALTER TABLE %s REORGANIZE PARTITION pmax INTO (%s)" % (
+                table, ", ".join(parts))))
+        return ["p%s" % month.strftime("%Y%m") for month in missing]
+
+    def _delete_rows(self, table: Table, condition: Any, batch_size: int) -> int:
+        deleted = 0
+        while True:
+            ids = [row_id for row_id, in self.db_handler.execute(
+                select(table.c.id).where(condition).limit(batch_size))]
+            if not ids:
+                return deleted
+            self.db_handler.execute(table.delete().where(table.c.id.in_(ids)))
+            self.db_handler.commit()
+            deleted += len(ids)
+
+    def expire(self, before: datetime, batch_size: int = 10000) -> Dict[str, Any]:
+        """
+        删除before之前的巡检记录. 整月过期的分区/分表直接删除, 其余按批删除并逐批提交
+        :return: Dict {"dropped": 删除的分区或分表, "deleted": 按行删除的记录数}
+        """
+        cutoff = month_start(before.date())
+        dropped = []
+        if self.partitioned and self.dialect == "mysql":
+            dropped = ["p%s" % month.strftime("%Y%m") for month in self.mysql_partitions().values()
+                       if month is not None and add_months(month, 1) <= cutoff]
+            if dropped:
+                self.db_handler.execute(text("ALTER TABLE %s DROP PARTITION %s" % (
+                    Inspection.__tablename__, ", ".join(dropped))))
+        elif self.monthly:
+            for month, table in self.month_tables().items():
+                if add_months(month, 1) <= cutoff:
+                    table.drop(self.db_handler.connection())
+                    _created.discard((str(self.db_handler.get_bind().url), table.name))
+                    dropped.append(table.name)
+            self.db_handler.commit()
+        deleted = 0
+        for table in self.tables(None, before):
+            deleted += self._delete_rows(table, table.c.timestamp < before, batch_size)
+        return {"dropped": dropped, "deleted": deleted}
+
+    def downsample(self, before: datetime) -> int:
+        """
+        降采样: before之前的记录每台设备每个动作每天只保留最后一条, 按天执行并逐天提交.
+        每日的通过/失败统计在inspection_rollup中, 不受影响, 降采样后不应再对这些日期rebuild_rollup
+        :return: int 删除的记录数
+        """
+        deleted = 0
+        for table in self.tables(None, before):
+            oldest = self.db_handler.execute(
+                select(func.min(table.c.timestamp)).where(table.c.timestamp < before)).scalar()
+            if oldest is None:
+                continue
+            day = datetime.combine(oldest.date(), time())
+            while day < before:
+                end = min(day + timedelta(days=1), before)
+                window = and_(table.c.timestamp >= day, table.c.timestamp < end)
+                # 子查询包一层派生表, MySQL不允许DELETE的子查询直接读同一张表
+                keep = select(func.max(table.c.id).label("id")).where(window) \
+                    .group_by(table.c.sn, table.c.action_id).subquery("keep")
+                result = self.db_handler.execute(
+                    table.delete().where(window, table.c.id.notin_(select(keep.c.id))))
+                self.db_handler.commit()
+                deleted += result.rowcount or 0
+                day = end
+        return deleted
+
+    def gc_outputs(self, grace: timedelta = OUTPUT_GC_GRACE) -> int:
+        """
+        删除不再被任何巡检记录引用的回显. 宽限期内写入或复用过的回显可能被尚未提交的巡检记录引用, 不删除
+        :param grace: 宽限期
+        :return: int 删除的回显数
+        """
+        output = InspectionOutput.__table__
+        unused = [~exists().where(table.c.output_hash == output.c.hash) for table in self.tables()]
+        result = self.db_handler.execute(
+            output.delete().where(output.c.created_at < datetime.now() - grace, *unused))
+        self.db_handler.commit()
+        return result.rowcount or 0
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from flask import Response, request, stream_with_context
+
+# 命名空间, 同一命名空间的缓存一起失效
+OPTIONS = "options"
+ACTIONS = "actions"
+
+
+class ResponseCache:
+    """
+    进程级的只读接口响应缓存, 保存序列化后的响应体及其ETag, 以(命名空间, 请求参数)为key, LRU淘汰.
+    数据变更后按命名空间失效, 其他进程通过注册的版本函数(如动作快照文件的修改时间)发现变更
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 300.0, max_entry_bytes: int = 4 * 1024 * 1024) -> None:
+        """
+        :param maxsize: 最多缓存的响应数
+        :param ttl: 响应最长缓存秒数, 兜底没有版本函数时其他进程写入的变更
+        :param max_entry_bytes: 超过该大小的响应不缓存
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (命名空间, key) -> (版本, 生成时间, 响应体, ETag, 生成函数)
+        self._entries: "OrderedDict[Tuple[str, Any], Tuple[Any, float, bytes, str, Callable[[], bytes]]]" = \
+            OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._versions: Dict[str, Callable[[], Any]] = {}
+
+    def register(self, namespace: str, version: Callable[[], Any]) -> None:
+        """
+        :param version: 返回数据版本的函数, 版本变化时缓存失效, 每次读取缓存都会调用, 应当足够廉价
+        """
+        self._versions[namespace] = version
+
+    def _version(self, namespace: str) -> Tuple[int, Any]:
+        version = self._versions.get(namespace)
+        return self._generations.get(namespace, 0), version() if version else None
+
+    def lookup(self, namespace: str, key: Any) -> Tuple[Optional[Tuple[bytes, str]], Any]:
+        """
+        :param key: 可hash的请求参数
+        :return: ((响应体, ETag)|None 未命中, 当前版本) 未命中时生成的响应体用这个版本调用store
+        """
+        version = self._version(namespace)
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] == version and time.monotonic() - entry[1] <= self.ttl:
+                self._entries.move_to_end((namespace, key))
+                self.hits += 1
+                return (entry[2], entry[3]), version
+            self.misses += 1
+        return None, version
+
+    def store(self, namespace: str, key: Any, version: Any, body: bytes,
+              build: Callable[[], bytes]) -> Tuple[bytes, str]:
+        """
+        :param version: lookup返回的版本, 即生成响应体之前的版本
+        :param build: 生成响应体的函数, 失效后重新生成时调用
+        :return: (响应体, ETag) 超过max_entry_bytes时不缓存
+        """
+        etag = hashlib.sha1(body).hexdigest()
+        if len(body) <= self.max_entry_bytes:
+            with self._lock:
+                self._entries[(namespace, key)] = (version, time.monotonic(), body, etag, build)
+                self._entries.move_to_end((namespace, key))
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return body, etag
+
+    def get(self, namespace: str, key: Any, build: Callable[[], bytes]) -> Tuple[bytes, str]:
+        """
+        :param key: 可hash的请求参数
+        :param build: 未命中时生成响应体的函数
+        :return: (响应体, ETag)
+        """
+        entry, version = self.lookup(namespace, key)
+        if entry is not None:
+            return entry
+        return self.store(namespace, key, version, build(), build)
+
+    def invalidate(self, namespace: str, rebuild: int = 0) -> None:
+        """
+        数据变更后调用, 丢弃该命名空间的全部缓存
+        :param rebuild: 立即重新生成最近使用的多少个响应, 写入后下一次读取不必等待
+        """
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            keys = [k for k in self._entries if k[0] == namespace]
+            hot = [(k[1], self._entries[k][4]) for k in reversed(keys)][:rebuild]
+            for k in keys:
+                del self._entries[k]
+        for key, build in hot:
+            try:
+                self.get(namespace, key, build)
+            except Exception:
+                continue
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+response_cache = ResponseCache()
+
+
+def cached_response(namespace: str, key: Any, build: Callable[[], bytes],
+                    mimetype: str = "application/json", cache: Optional[ResponseCache] = None) -> Response:
+    """
+    返回带ETag的缓存响应, 请求头If-None-Match与ETag一致时返回304
+    """
+    body, etag = (cache or response_cache).get(namespace, key, build)
+    return _conditional_response(body, etag, mimetype)
+
+
+def cached_stream(namespace: str, key: Any, generate: Callable[[], Iterable[bytes]],
+                  mimetype: str = "application/json", cache: Optional[ResponseCache] = None) -> Response:
+    """
+    结果大小未知的查询: 未命中时边生成边缓冲, 在max_entry_bytes以内生成完毕则缓存并返回带ETag的响应,
+    超过时不再缓冲, 已生成的部分和剩余部分流式输出(不缓存, 没有ETag)
+    :param generate: 返回响应体片段的函数
+    """
+    cache = cache or response_cache
+    entry, version = cache.lookup(namespace, key)
+    if entry is None:
+        chunks = []
+        size = 0
+        iterator = iter(generate())
+        for chunk in iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > cache.max_entry_bytes:
+                def rest():
+                    yield from chunks
+                    yield from iterator
+                return Response(stream_with_context(rest()), mimetype=mimetype)
+        entry = cache.store(namespace, key, version, b"".join(chunks), lambda: b"".join(generate()))
+    return _conditional_response(entry[0], entry[1], mimetype)
+
+
+def _conditional_response(body: bytes, etag: str, mimetype: str) -> Response:
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    # 允许客户端缓存, 但每次都要用ETag重新验证
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
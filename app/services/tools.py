@@ -3,6 +3,8 @@ import inspect
 
 from hobbit_core.db import EnumExt
 
+from app.utils.serializer import dumps
+
 
 class OptionService:
 
@@ -15,3 +17,10 @@ class OptionService:
             if inspect.isclass(obj) and issubclass(obj, EnumExt) and
             obj != EnumExt
         }
+
+    @classmethod
+    def dumps(cls) -> bytes:
+        """
+        序列化的选项, 内容只随代码变化, 由response_cache缓存
+        """
+        return dumps(cls.get_options(), sort_keys=True)
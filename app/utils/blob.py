@@ -0,0 +1,35 @@
+import hashlib
+import zlib
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+def digest(text: str) -> str:
+    """
+    :param text: 原始内容
+    :return: str 内容的sha256, 作为去重存储的key
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress(text: str) -> Tuple[str, bytes]:
+    """
+    安装了zstandard时用zstd, 否则用zlib
+    :return: (压缩方式, 压缩后的内容)
+    """
+    data = text.encode("utf-8")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 6)
+
+
+def decompress(codec: str, data: bytes) -> str:
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
@@ -0,0 +1,144 @@
+import json
+import math
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+try:
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    parquet = None
+else:
+    parquet = pyarrow.parquet
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def value_type(value: Any) -> Optional[str]:
+    """
+    :return: str [bool|int|float|datetime|str] 空值为None
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, datetime):
+        return "datetime"
+    return "str"
+
+
+def promote(kind: Optional[str], other: Optional[str]) -> Optional[str]:
+    """
+    合并两个类型: int和float合并为float, 其他不同的类型合并为str
+    """
+    if kind is None or kind == other:
+        return other
+    if other is None:
+        return kind
+    if {kind, other} == {"int", "float"}:
+        return "float"
+    return "str"
+
+
+def infer_type(values: List[Any]) -> str:
+    """
+    推断一列的类型, 混合类型的列按字符串处理
+    :return: str [bool|int|float|datetime|str]
+    """
+    kind = None
+    for value in values:
+        kind = promote(kind, value_type(value))
+    return kind or "str"
+
+
+def update_schema(schema: Dict[str, Optional[str]], row: Dict[str, Any]) -> None:
+    """
+    用一行数据更新多个文件共用的schema, 新出现的列追加在最后
+    :param schema: Dict[列名, 类型] 原地修改, 只出现过空值的列类型为None
+    """
+    for name, value in row.items():
+        schema[name] = promote(schema.get(name), value_type(value))
+
+
+def _to_str(value: Any) -> Any:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _write_arrow(path: str, columns: Dict[str, List[Any]], schema: Optional[Dict[str, Optional[str]]]) -> str:
+    types = {
+        "bool": pyarrow.bool_(), "int": pyarrow.int64(), "float": pyarrow.float64(),
+        "datetime": pyarrow.timestamp("s"), "str": pyarrow.string(),
+    }
+    arrays = {}
+    for name, values in columns.items():
+        kind = (schema.get(name) or "str") if schema is not None else infer_type(values)
+        if kind == "str":
+            values = [_to_str(value) for value in values]
+        arrays[name] = pyarrow.array(values, type=types[kind])
+    table = pyarrow.table(arrays)
+    if parquet is not None:
+        path = "%s.parquet" % path
+        parquet.write_table(table, path, compression="zstd")
+        return path
+    path = "%s.arrow" % path
+    with pyarrow.OSFile(path, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def _write_npz(path: str, columns: Dict[str, List[Any]], schema: Optional[Dict[str, Optional[str]]]) -> str:
+    arrays = {}
+    for name, values in columns.items():
+        kind = (schema.get(name) or "str") if schema is not None else infer_type(values)
+        if kind == "bool":
+            # -1表示空值
+            arrays[name] = numpy.array([-1 if v is None else int(v) for v in values], dtype=numpy.int8)
+        elif kind == "int" and schema is None and None not in values:
+            # 指定了schema时整数列统一存为float64, 否则有空值的文件和没有空值的文件类型不同
+            arrays[name] = numpy.array(values, dtype=numpy.int64)
+        elif kind in ("int", "float"):
+            arrays[name] = numpy.array([math.nan if v is None else v for v in values], dtype=numpy.float64)
+        elif kind == "datetime":
+            arrays[name] = numpy.array(values, dtype="datetime64[s]")
+        else:
+            arrays[name] = numpy.array(["" if v is None else _to_str(v) for v in values], dtype=str)
+    path = "%s.npz" % path
+    numpy.savez_compressed(path, **arrays)
+    return path
+
+
+def write_columns(path: str, columns: Dict[str, List[Any]],
+                  schema: Optional[Dict[str, Optional[str]]] = None) -> str:
+    """
+    按列写入带类型的文件: 安装了pyarrow时写Parquet(没有parquet模块时写Arrow IPC), 否则写压缩的NPZ
+    :param path: 不带扩展名的文件路径
+    :param columns: Dict[列名, 值列表]
+    :param schema: Dict[列名, 类型] 同一次导出的多个文件共用, 保证各文件的列和类型一致; 为空时按本文件的数据推断
+    :return: str 实际写入的文件路径
+    """
+    if schema is not None:
+        # 按schema的列顺序输出, 本文件中没有的列补空值
+        size = max((len(values) for values in columns.values()), default=0)
+        columns = {name: columns[name] if name in columns else [None] * size for name in schema}
+    if pyarrow is not None:
+        return _write_arrow(path, columns, schema)
+    if numpy is not None:
+        return _write_npz(path, columns, schema)
+    raise Exception("columnar export requires pyarrow or numpy")
@@ -0,0 +1,96 @@
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+
+class ConnectionPool:
+    """
+    线程安全的DB-API连接池: 取出时ping检查, 失效或超过最大存活时间的连接重新创建
+    """
+
+    def __init__(self, creator: Callable[[], Any], max_size: int = 10, max_lifetime: float = 3600,
+                 timeout: float = 30, ping: Optional[Callable[[Any], None]] = None) -> None:
+        """
+        :param creator: 创建连接的函数, 如 functools.partial(pymysql.connect, ...)
+        :param max_size: 最多同时借出的连接数
+        :param max_lifetime: 连接最长存活秒数, 超过后关闭重建, 避免被服务端wait_timeout断开
+        :param timeout: 连接全部借出时等待的秒数
+        :param ping: 检查连接是否可用的函数, 不可用时抛异常
+        """
+        self.creator = creator
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.ping = ping or self._ping
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # (连接, 创建时间)
+        self._idle: List[Tuple[Any, float]] = []
+
+    @staticmethod
+    def _ping(conn: Any) -> None:
+        ping = getattr(conn, "ping", None)
+        if callable(ping):
+            ping()
+            return
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _close(conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self) -> Tuple[Any, float]:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Exception("db connection pool exhausted, %d connections in use" % self.max_size)
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self.creator(), time.monotonic()
+                conn, created_at = entry
+                if time.monotonic() - created_at > self.max_lifetime:
+                    self._close(conn)
+                    continue
+                try:
+                    self.ping(conn)
+                except Exception:
+                    self._close(conn)
+                    continue
+                return entry
+        except BaseException:
+            self._slots.release()
+            raise
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[Any]:
+        """
+        借出一个连接, 使用完自动归还. 归还前回滚未提交的事务, 回滚失败的连接直接丢弃
+        """
+        conn, created_at = self._checkout()
+        try:
+            yield conn
+        finally:
+            try:
+                conn.rollback()
+            except Exception:
+                self._close(conn)
+                conn = None
+            if conn is not None:
+                with self._lock:
+                    self._idle.append((conn, created_at))
+            self._slots.release()
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
@@ -1,4 +1,20 @@
-from typing import Dict, Any
+from typing import Dict, Any, FrozenSet, Iterable, List, Tuple
+
+from app.utils.serializer import serializer_for
+
+# 模型类 -> 列名集合, 每个模型只计算一次
+_columns: Dict[Any, FrozenSet[str]] = {}
+
+
+def column_names(cls: Any) -> FrozenSet[str]:
+    """
+    :param cls: ClassVar 模型类
+    :return: FrozenSet[str] 模型定义的所有列名
+    """
+    columns = _columns.get(cls)
+    if columns is None:
+        columns = _columns[cls] = frozenset(c.name for c in cls.__table__.columns)
+    return columns
 
 
 def to_model(cls: Any, **kwargs: Dict) -> Any:
@@ -9,17 +25,66 @@ def to_model(cls: Any, **kwargs: Dict) -> Any:
     :return: ClassVar
     """
     device = cls()  # 实例化一个对象
-    columns = [c.name for c in cls.__table__.columns]  # 获取模型定义的所有列属性的名字
+    columns = column_names(cls)  # 获取模型定义的所有列属性的名字
     for k, v in kwargs.items():  # 遍历传入kwargs的键值
         if k in columns:  # 如果键包含在列名中，则为该对象赋加对应的属性值
             setattr(device, k, v)
     return device
 
 
+def to_models(cls: Any, rows: Iterable[Dict]) -> List[Any]:
+    """
+    批量生成对象
+    :param cls: ClassVar 目标对象
+    :param rows: Iterable[Dict] 关键字字典
+    :return: List[ClassVar]
+    """
+    columns = column_names(cls)
+    result = []
+    for kwargs in rows:
+        obj = cls()
+        for k, v in kwargs.items():
+            if k in columns:
+                setattr(obj, k, v)
+        result.append(obj)
+    return result
+
+
+def to_mappings(cls: Any, rows: Iterable[Dict]) -> List[Dict]:
+    """
+    只保留模型中定义的列, 用于Core批量插入, 不构造ORM对象
+    :return: List[Dict]
+    """
+    columns = column_names(cls)
+    return [{k: v for k, v in kwargs.items() if k in columns} for kwargs in rows]
+
+
+def bulk_insert(session: Any, cls: Any, rows: Iterable[Dict], chunk_size: int = 1000) -> int:
+    """
+    用Core的executemany批量插入, 不经过ORM的对象构造和unit of work, 不提交事务.
+    executemany要求每行的字段相同, 按字段分组执行
+    :param session: 数据库会话
+    :param cls: ClassVar 模型类
+    :param rows: Iterable[Dict] 待插入的数据
+    :param chunk_size: 每次executemany的行数
+    :return: int 插入的行数
+    """
+    groups: Dict[Tuple[str, ...], List[Dict]] = {}
+    for mapping in to_mappings(cls, rows):
+        groups.setdefault(tuple(sorted(mapping)), []).append(mapping)
+    table = cls.__table__
+    count = 0
+    for mappings in groups.values():
+        for i in range(0, len(mappings), chunk_size):
+            session.execute(table.insert(), mappings[i:i + chunk_size])
+            count += len(mappings[i:i + chunk_size])
+    return count
+
+
 def to_dict(self: Any) -> Dict:
     """
-    将实例对象的属性生成字典
+    将实例对象的属性生成字典, 日期时间转为字符串, Numeric转为float
     :param self: ClassVar 对象实例
     :return: Dict
     """
-    return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+    return serializer_for(type(self)).to_dict(self)
@@ -0,0 +1,96 @@
+import functools
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+RANGE_OPERATORS = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+
+def build_where(condition: Optional[Dict[str, Any]], columns: Dict[str, str],
+                placeholder: str = "%s") -> Tuple[str, List[Any]]:
+    """
+    生成参数化的WHERE条件, 多个条件之间为AND
+        {"vendor": "huawei"}                 -> vendor = %s
+        {"idc": ["bj1", "bj2"]}              -> idc IN (%s, %s)
+        {"updated_at": {"gte": t1, "lt": t2}} -> updated_at >= %s AND updated_at < %s
+        {"role": None}                        -> role IS NULL
+    :param condition: Dict[Str, Any] 筛选条件
+    :param columns: Dict[字段名, SQL中的列] 允许筛选的字段, 字段名不会拼接进SQL
+    :param placeholder: 驱动的参数占位符, pymysql为%s, sqlite3为?
+    :return: (条件, 参数)
+    """
+    clauses = []
+    params = []
+    for k, v in (condition or {}).items():
+        if k not in columns:
+            raise Exception("unknown column %s" % k)
+        col = columns[k]
+        if v is None:
+            clauses.append("%s IS NULL" % col)
+        elif isinstance(v, (list, tuple, set, frozenset)):
+            v = list(v)
+            if not v:
+                clauses.append("1 = 0")
+                continue
+            clauses.append("%s IN (%s)" % (col, ", ".join([placeholder] * len(v))))
+            params.extend(v)
+        elif isinstance(v, dict):
+            for op, bound in v.items():
+                if op not in RANGE_OPERATORS:
+                    raise Exception("unknown range operator %s" % op)
+                clauses.append("%s %s %s" % (col, RANGE_OPERATORS[op], placeholder))
+                params.append(bound)
+        else:
+            clauses.append("%s = %s" % (col, placeholder))
+            params.append(v)
+    return " AND ".join(clauses), params
+
+
+def build_select(from_sql: str, columns: Dict[str, str], condition: Optional[Dict[str, Any]] = None,
+                 projection: Optional[Iterable[str]] = None, placeholder: str = "%s",
+                 order_by: Optional[str] = None) -> Tuple[str, List[Any]]:
+    """
+    :param from_sql: FROM之后的表或JOIN语句
+    :param columns: Dict[字段名, SQL中的列] 可查询的字段
+    :param condition: Dict[Str, Any] 筛选条件, 见build_where
+    :param projection: 需要返回的字段, 默认全部
+    :param placeholder: 驱动的参数占位符
+    :param order_by: 排序字段
+    :return: (SQL, 参数)
+    """
+    projection = list(projection or columns)
+    for name in projection + ([order_by] if order_by else []):
+        if name not in columns:
+            raise Exception("unknown column %s" % name)
+    sql = "select %s from %s" % (", ".join("%s as %s" % (columns[name], name) for name in projection), from_sql)
+    where, params = build_where(condition, columns, placeholder)
+    if where:
+        sql += " where %s" % where
+    if order_by:
+        sql += " order by %s" % columns[order_by]
+    return sql, params
+
+
+@functools.lru_cache(maxsize=64)
+def build_upsert(table: str, columns: Tuple[str, ...], count: int, keys: Tuple[str, ...] = ("sn",),
+                 dialect: str = "mysql", placeholder: str = "%s") -> str:
+    """
+    生成多行插入语句, 主键冲突时更新其余字段. 同一批次大小的SQL只生成一次
+    :param table: 表名
+    :param columns: 插入的字段
+    :param count: 行数
+    :param keys: 冲突判断的字段, sqlite需要
+    :param dialect: str [mysql|sqlite]
+    :param placeholder: 驱动的参数占位符
+    :return: SQL, 参数按行展开传入
+    """
+    row = "(%s)" % ", ".join([placeholder] * len(columns))
+    sql = "insert into %s (%s) values %s" % (
+        table, ", ".join("`%s`" % c for c in columns), ", ".join([row] * count))
+    updates = [c for c in columns if c not in keys]
+    if dialect == "mysql":
+        sql += " on duplicate key update %s" % ", ".join("`%s` = values(`%s`)" % (c, c) for c in updates)
+    elif dialect == "sqlite":
+        sql += " on conflict (%s) do update set %s" % (
+            ", ".join("`%s`" % k for k in keys), ", ".join("`%s` = excluded.`%s`" % (c, c) for c in updates))
+    else:
+        raise Exception("unsupported dialect %s" % dialect)
+    return sql
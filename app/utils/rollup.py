@@ -0,0 +1,83 @@
+import json
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+# 汇总表的维度
+ROLLUP_KEYS = ("day", "idc", "vendor", "action_id", "metric")
+# 整条校验结果的汇总, 任一字段失败即为失败
+ALL_METRICS = "*"
+PASS_VALUES = {"pass", "passed", "ok", "normal", "success", "true", "yes"}
+FAIL_VALUES = {"fail", "failed", "error", "abnormal", "false", "no"}
+
+
+def classify(value: Any) -> Optional[Union[str, float]]:
+    """
+    判断校验字段的取值
+    :return: "pass"|"fail"|float 数值|None 无法判断
+    """
+    if isinstance(value, bool):
+        return "pass" if value else "fail"
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in PASS_VALUES:
+            return "pass"
+        if value in FAIL_VALUES:
+            return "fail"
+    return None
+
+
+def empty() -> Dict[str, Any]:
+    return {"pass_count": 0, "fail_count": 0, "value_count": 0, "value_sum": 0.0,
+            "value_min": None, "value_max": None}
+
+
+def _add(stat: Dict[str, Any], kind: Union[str, float]) -> None:
+    if kind == "pass":
+        stat["pass_count"] += 1
+    elif kind == "fail":
+        stat["fail_count"] += 1
+    else:
+        stat["value_count"] += 1
+        stat["value_sum"] += kind
+        stat["value_min"] = kind if stat["value_min"] is None else min(stat["value_min"], kind)
+        stat["value_max"] = kind if stat["value_max"] is None else max(stat["value_max"], kind)
+
+
+def aggregate(rows: Iterable[Dict], default_day: Optional[date] = None) -> Dict[Tuple, Dict[str, Any]]:
+    """
+    把一批巡检记录汇总为(日期, 机房, 厂商, 动作, 校验字段)的增量
+    :param rows: 巡检记录, 包含action_id/validation_result, 可选idc/vendor/timestamp
+    :param default_day: 没有timestamp的记录计入的日期, 默认今天
+    :return: Dict[(day, idc, vendor, action_id, metric), {"pass_count", "fail_count", "value_count",
+             "value_sum", "value_min", "value_max"}]
+    """
+    default_day = default_day or date.today()
+    result: Dict[Tuple, Dict[str, Any]] = {}
+    for row in rows:
+        validation_result = row.get("validation_result")
+        if isinstance(validation_result, (str, bytes)):
+            try:
+                validation_result = json.loads(validation_result)
+            except ValueError:
+                continue
+        if isinstance(validation_result, dict):
+            validation_result = [validation_result]
+        if not isinstance(validation_result, list):
+            continue
+        timestamp = row.get("timestamp")
+        day = timestamp.date() if isinstance(timestamp, datetime) else default_day
+        base = (day, row.get("idc") or "", row.get("vendor") or "", row.get("action_id") or 0)
+        failed = False
+        for item in validation_result:
+            if not isinstance(item, dict):
+                continue
+            for metric, value in item.items():
+                kind = classify(value)
+                if kind is None:
+                    continue
+                failed = failed or kind == "fail"
+                _add(result.setdefault(base + (str(metric)[:128],), empty()), kind)
+        _add(result.setdefault(base + (ALL_METRICS,), empty()), "fail" if failed else "pass")
+    return result
@@ -0,0 +1,118 @@
+import json
+import operator
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import DateTime, Numeric
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """
+    序列化为UTF-8编码的JSON, 安装了orjson时使用orjson
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, separators=(",", ":")).encode("utf-8")
+
+
+def format_datetime(value: Any) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else ""
+
+
+def to_float(value: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+# 列类型 -> 转换函数, 按顺序匹配第一个
+CONVERTERS = [(DateTime, format_datetime), (Numeric, to_float)]
+
+
+class ModelSerializer:
+    """
+    模型的序列化器: 列名及每列的转换函数只在创建时计算一次, 之后每行只做取值和转换
+    """
+
+    def __init__(self, cls: Any) -> None:
+        columns = list(cls.__table__.columns)
+        self.names = [c.name for c in columns]
+        self._getter = operator.attrgetter(*self.names)
+        self._converters = []
+        for idx, column in enumerate(columns):
+            for column_type, converter in CONVERTERS:
+                if isinstance(column.type, column_type):
+                    self._converters.append((idx, converter))
+                    break
+
+    def to_dict(self, obj: Any) -> Dict[str, Any]:
+        # 已经是字典(如从快照读取)时直接返回
+        if isinstance(obj, dict):
+            return obj
+        values = self._getter(obj)
+        if len(self.names) == 1:
+            values = (values,)
+        if self._converters:
+            values = list(values)
+            for idx, converter in self._converters:
+                values[idx] = converter(values[idx])
+        return dict(zip(self.names, values))
+
+    def to_dicts(self, rows: Iterable[Any]) -> List[Dict[str, Any]]:
+        to_dict = self.to_dict
+        return [to_dict(row) for row in rows]
+
+    def dumps(self, rows: Iterable[Any]) -> bytes:
+        """
+        :return: bytes JSON数组
+        """
+        return dumps(self.to_dicts(rows))
+
+    def iter_json(self, rows: Iterable[Any], batch_size: int = 1000) -> Iterator[bytes]:
+        """
+        流式输出JSON数组, 每batch_size行编码一次
+        """
+        yield b"["
+        first = True
+        for batch in _batches(rows, batch_size):
+            body = dumps(self.to_dicts(batch))[1:-1]
+            yield body if first else b"," + body
+            first = False
+        yield b"]"
+
+    def iter_ndjson(self, rows: Iterable[Any], batch_size: int = 1000) -> Iterator[bytes]:
+        """
+        流式输出NDJSON, 每行一条
+        """
+        for batch in _batches(rows, batch_size):
+            yield b"".join(dumps(item) + b"\n" for item in self.to_dicts(batch))
+
+
+def _batches(rows: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_serializers: Dict[type, ModelSerializer] = {}
+_lock = threading.Lock()
+
+
+def serializer_for(cls: Any) -> ModelSerializer:
+    """
+    :param cls: 模型类
+    :return: ModelSerializer 每个模型只创建一次
+    """
+    serializer = _serializers.get(cls)
+    if serializer is None:
+        with _lock:
+            serializer = _serializers.setdefault(cls, ModelSerializer(cls))
+    return serializer
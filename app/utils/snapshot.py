@@ -0,0 +1,260 @@
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# 快照文件布局:
+#   header | 字段目录 | 记录偏移表(count + 1) | 记录(JSON, 按id升序) | 每个字段的有序取值表 + 取值 + 倒排列表
+_MAGIC = b"OPAC"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHQQ")  # magic, 版本, 字段数, 代数, 记录数
+_FIELD = struct.Struct("<16sQI")  # 字段名, 取值表偏移, 取值个数
+_ENTRY = struct.Struct("<QIQI")  # 取值偏移, 取值长度, 倒排偏移, 倒排长度
+_OFFSET = struct.Struct("<Q")
+
+INDEX_FIELDS = ("vendor", "model", "name", "cmd")
+
+
+def _encode_key(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def _read_generation(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            magic, _, _, generation, _ = _HEADER.unpack(f.read(_HEADER.size))
+        return generation if magic == _MAGIC else 0
+    except (OSError, struct.error):
+        return 0
+
+
+@contextlib.contextmanager
+def snapshot_lock(path: str) -> Iterator[None]:
+    """
+    发布快照的进程间排他锁(<path>.lock). 读取数据源、写文件和rename都应在锁内完成,
+    否则较早读到旧数据的进程可能后rename, 用旧快照覆盖新快照
+    """
+    with open("%s.lock" % path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def publish_snapshot(path: str, items: Iterable[Dict], fields: Tuple[str, ...] = INDEX_FIELDS,
+                     lock: bool = True) -> int:
+    """
+    把目录编译为只读的二进制快照, 写临时文件后rename, 发布新的一代
+    :param path: 快照文件路径
+    :param items: Iterable[Dict] 目录数据
+    :param fields: 建立索引的字段
+    :param lock: 是否在此获取snapshot_lock, 调用方已经持有锁(如需要在锁内查询数据源)时传False
+    :return: int 新快照的代数
+    """
+    if lock:
+        with snapshot_lock(path):
+            return publish_snapshot(path, items, fields, lock=False)
+    # (id, 记录, 各索引字段的取值)
+    rows = []
+    ordered = True
+    for item in items:
+        row_id = item.get("id") or 0
+        ordered = ordered and (not rows or rows[-1][0] <= row_id)
+        rows.append((row_id, json.dumps(item, ensure_ascii=False).encode("utf-8"),
+                     [_encode_key(item.get(field)) for field in fields]))
+    # 记录按id排序, 分页时可以二分定位游标, 倒排列表也随之有序
+    if not ordered:
+        rows.sort(key=lambda row: row[0])
+    records = []
+    postings = {field: {} for field in fields}
+    for idx, (_, record, keys) in enumerate(rows):
+        records.append(record)
+        for field, key in zip(fields, keys):
+            postings[field].setdefault(key, []).append(idx)
+    del rows
+
+    generation = _read_generation(path) + 1
+    pos = _HEADER.size + _FIELD.size * len(fields) + _OFFSET.size * (len(records) + 1)
+    offsets = []
+    for record in records:
+        offsets.append(pos)
+        pos += len(record)
+    offsets.append(pos)
+
+    field_dir = []
+    index_blocks = []
+    for field in fields:
+        keys = sorted(postings[field])
+        table_offset = pos
+        pos += _ENTRY.size * len(keys)
+        entries = []
+        blobs = []
+        for key in keys:
+            ids = postings[field][key]
+            entries.append(_ENTRY.pack(pos, len(key), pos + len(key), len(ids)))
+            blobs.append(key)
+            blobs.append(struct.pack("<%dI" % len(ids), *ids))
+            pos += len(key) + 4 * len(ids)
+        field_dir.append(_FIELD.pack(field.encode("utf-8"), table_offset, len(keys)))
+        index_blocks.extend(entries)
+        index_blocks.extend(blobs)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(fields), generation, len(records)))
+        f.writelines(field_dir)
+        f.writelines(_OFFSET.pack(offset) for offset in offsets)
+        f.writelines(records)
+        f.writelines(index_blocks)
+        f.flush()
+        os.fsync(f.fileno())
+    # 已经映射旧快照的进程继续持有旧inode, 下次访问时切换到新的一代
+    os.replace(tmp, path)
+    return generation
+
+
+class ActionSnapshot:
+    """
+    以mmap方式只读访问快照, 同一台机器上的多个worker共享page cache中的同一份数据
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: 快照文件路径
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._state: Optional[Tuple] = None
+
+    def _current(self) -> Tuple:
+        """
+        快照文件被替换(inode变化)时重新映射
+        :return: (文件标识, mmap, 代数, 记录数, 字段目录)
+        """
+        st = os.stat(self.path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        state = self._state
+        if state is not None and state[0] == key:
+            return state
+        with self._lock:
+            if self._state is not None and self._state[0] == key:
+                return self._state
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, nfields, generation, count = _HEADER.unpack_from(mm, 0)
+            if magic != _MAGIC or version != _VERSION:
+                raise Exception("%s is not a valid action snapshot" % self.path)
+            fields = {}
+            for i in range(nfields):
+                name, table_offset, nkeys = _FIELD.unpack_from(mm, _HEADER.size + i * _FIELD.size)
+                fields[name.rstrip(b"\0").decode("utf-8")] = (table_offset, nkeys)
+            self._state = (key, mm, generation, count, fields)
+            return self._state
+
+    @property
+    def generation(self) -> int:
+        return self._current()[2]
+
+    def __len__(self) -> int:
+        return self._current()[3]
+
+    @staticmethod
+    def _record(state: Tuple, idx: int) -> Dict:
+        mm, fields = state[1], state[4]
+        pos = _HEADER.size + _FIELD.size * len(fields) + _OFFSET.size * idx
+        start, = _OFFSET.unpack_from(mm, pos)
+        end, = _OFFSET.unpack_from(mm, pos + _OFFSET.size)
+        return json.loads(mm[start:end])
+
+    @staticmethod
+    def _lookup(state: Tuple, field: str, value: Any) -> List[int]:
+        """
+        在有序取值表上二分查找
+        :return: List[int] 匹配的记录序号
+        """
+        mm = state[1]
+        table_offset, nkeys = state[4][field]
+        key = _encode_key(value)
+        lo, hi = 0, nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, key_len, ids_offset, nids = _ENTRY.unpack_from(mm, table_offset + mid * _ENTRY.size)
+            current = mm[key_offset:key_offset + key_len]
+            if current == key:
+                return list(struct.unpack_from("<%dI" % nids, mm, ids_offset))
+            if current < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return []
+
+    def _seek(self, state: Tuple, candidates: Any, after_id: int) -> int:
+        """
+        记录按id升序, 二分查找第一个id大于after_id的候选位置
+        """
+        lo, hi = 0, len(candidates)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (self._record(state, candidates[mid]).get("id") or 0) <= after_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def scan(self, condition: Optional[Dict] = None, after_id: int = 0,
+             limit: Optional[int] = None) -> Iterator[Dict]:
+        """
+        按id升序逐条返回, 与数据库查询的语义一致: 条件精确匹配(包括空值).
+        二分定位到after_id之后按需解码, 每页的代价只和limit及跳过的不匹配记录有关
+        :param condition: Dict[Str, Any] 筛选条件
+        :param after_id: int 只返回id大于该值的数据
+        :param limit: int 最多返回的条数, 为空时返回全部
+        :return: Iterator[Dict]
+        """
+        state = self._current()
+        condition = condition or {}
+        candidates = None
+        for k, v in condition.items():
+            if k not in state[4]:
+                continue
+            ids = self._lookup(state, k, v)
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        if candidates is None:
+            candidates = range(state[3])
+        count = 0
+        for pos in range(self._seek(state, candidates, after_id) if after_id else 0, len(candidates)):
+            if limit and count >= limit:
+                return
+            item = self._record(state, candidates[pos])
+            if all(item.get(k) == v for k, v in condition.items()):
+                count += 1
+                yield item
+
+    def get(self, condition: Optional[Dict] = None) -> List[Dict]:
+        """
+        :param condition: Dict[Str, Any] 筛选条件, 值为空的条件忽略
+        :return: List[Dict]
+        """
+        state = self._current()
+        condition = {k: v for k, v in (condition or {}).items() if v}
+        candidates = None
+        for k, v in condition.items():
+            if k not in state[4]:
+                continue
+            ids = self._lookup(state, k, v)
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        if candidates is None:
+            candidates = range(state[3])
+        result = []
+        for idx in candidates:
+            item = self._record(state, idx)
+            if all(item.get(k) == v for k, v in condition.items()):
+                result.append(item)
+        return result
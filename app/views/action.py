@@ -1,15 +1,34 @@
+import os
+
 from flask import Blueprint, request, current_app
 from ..models import db
 from app.services import ActionORMHandler
+from app.services.response_cache import ACTIONS, cached_stream, response_cache
+from app.models import Action
+from app.utils.serializer import serializer_for
 
 action_blueprint = Blueprint("action", __name__, url_prefix="/action")
 
 
+def snapshot_version():
+    """
+    动作快照文件的修改时间, 其他进程写入动作后会重新发布快照, 以此判断缓存是否过期
+    """
+    path = current_app.config.get("ACTION_SNAPSHOT_PATH")
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+response_cache.register(ACTIONS, snapshot_version)
+
+
 @action_blueprint.route("/add", methods=["POST"])
 def add():
     data = request.get_json()
     try:
-        ActionORMHandler(db.session()).add(data)
+        ActionORMHandler(db.session(), current_app.config.get("ACTION_SNAPSHOT_PATH")).add(data)
         current_app.logger.success("add success")
         return "success"
     except Exception as e:
@@ -21,19 +40,39 @@ def add():
 @action_blueprint.route("delete", methods=["POST"])
 def delete():
     data = request.get_json()
-    ActionORMHandler(db.session()).delete(data)
+    ActionORMHandler(db.session(), current_app.config.get("ACTION_SNAPSHOT_PATH")).delete(data)
     return "success"
 
 
 @action_blueprint.route("update", methods=["POST"])
 def update():
     data = request.get_json()
-    ActionORMHandler(db.session()).update(data)
-    return "success"
+    return ActionORMHandler(db.session(), current_app.config.get("ACTION_SNAPSHOT_PATH")).update(data)
 
 
 @action_blueprint.route("/get")
 def get():
+    """
+    after_id: 游标, 传上一页最后一条的id; limit: 每页条数, 不传则导出全部
+    format: json(默认, 流式输出的数组) | ndjson(每行一条)
+    """
     args = request.args.to_dict()
-    res = ActionORMHandler(db.session()).get(args)
-    return [item.to_dict() for item in res]
+    after_id = int(args.pop("after_id", 0) or 0)
+    limit = int(args.pop("limit", 0) or 0) or None
+    fmt = args.pop("format", "json")
+
+    def scan():
+        return ActionORMHandler(db.session(), current_app.config.get("ACTION_SNAPSHOT_PATH")).scan(
+            args, after_id=after_id, limit=limit)
+
+    serializer = serializer_for(Action)
+
+    def generate():
+        if fmt == "ndjson":
+            return serializer.iter_ndjson(scan())
+        return serializer.iter_json(scan())
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    # 响应体不超过缓存上限时缓存并带ETag, 超过时(如全量导出)转为流式输出, 每个请求最多缓冲max_entry_bytes
+    key = (tuple(sorted(args.items())), after_id, limit, fmt)
+    return cached_stream(ACTIONS, key, generate, mimetype)
@@ -0,0 +1,58 @@
+from datetime import date, datetime
+
+from flask import Blueprint, Response, current_app, request, stream_with_context
+
+from app.exts import db
+from app.services import DeviceDBHandler, DeviceInventory, InspectionORMHandler
+from app.utils.serializer import dumps
+
+bp = Blueprint('inspection', __name__, url_prefix='/inspection')
+
+
+def device_inventory() -> DeviceInventory:
+    """ Inventory cache shared by all requests of this app, synced incrementally.
+    """
+    inventory = current_app.extensions.get('device_inventory')
+    if inventory is None:
+        inventory = current_app.extensions.setdefault('device_inventory', DeviceInventory(
+            DeviceDBHandler(**current_app.config['DEVICE_DB']),
+            interval=current_app.config.get('DEVICE_INVENTORY_INTERVAL', 60)))
+    return inventory
+
+
+@bp.route('/export', methods=['GET'])
+def export():
+    """ Stream inspection results as CSV, start/end are unix timestamps.
+    """
+    start_time = datetime.fromtimestamp(int(request.args['start']))
+    end_time = datetime.fromtimestamp(int(request.args['end']))
+    device_handler = device_inventory()
+
+    def generate():
+        yield from InspectionORMHandler(db.session()).iter_export(device_handler, start_time, end_time)
+
+    filename = f"export_{start_time:%Y%m%d%H%M%S}_{end_time:%Y%m%d%H%M%S}.csv"
+    return Response(
+        stream_with_context(generate()), mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@bp.route('/rollup', methods=['GET'])
+def rollup():
+    """ Pass/fail counts and numeric min/max/avg from the daily rollup table.
+        start/end are YYYY-MM-DD (inclusive), group_by defaults to day,idc,vendor,action_id,metric,
+        idc/vendor/action_id/metric filters accept comma separated lists.
+    """
+    start_day = date.fromisoformat(request.args['start'])
+    end_day = date.fromisoformat(request.args.get('end', request.args['start']))
+    group_by = tuple(filter(None, request.args.get('group_by', 'day,idc,vendor,action_id,metric').split(',')))
+    filters = {}
+    for name in ('idc', 'vendor', 'action_id', 'metric'):
+        if name in request.args:
+            values = request.args[name].split(',')
+            filters[name] = [int(v) for v in values] if name == 'action_id' else values
+    result = InspectionORMHandler(db.session()).query_rollup(start_day, end_day, group_by, **filters)
+    for item in result:
+        if 'day' in item:
+            item['day'] = item['day'].isoformat()
+    return Response(dumps(result), mimetype='application/json')
@@ -3,6 +3,7 @@ from flask import Blueprint, jsonify
 from hobbit_core.pagination import PageParams, pagination  # NOQA
 
 from app.services import OptionService
+from app.services.response_cache import OPTIONS, cached_response
 
 bp = Blueprint('tools', __name__)
 
@@ -16,6 +17,6 @@ def ping():
 
 @bp.route('/options', methods=['GET'])
 def option():
-    """ List all enums for frontend.
+    """ List all enums for frontend, cached with ETag.
     """
-    return jsonify(OptionService.get_options())
+    return cached_response(OPTIONS, None, OptionService.dumps)
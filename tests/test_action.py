@@ -0,0 +1,191 @@
+import csv
+import io
+import json
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+
+from app.exts import db
+from app.models.inspection import Inspection, InspectionRollup
+from app.services import action as action_service
+from app.services.action import ActionJSONHandler, ActionORMHandler, InspectionORMHandler, InspectionService
+from app.services.parser import result_cache
+from app.utils.rollup import aggregate
+from app.utils.snapshot import publish_snapshot
+
+from . import BaseTest
+
+
+class TestActionSnapshotRead(BaseTest):
+
+    items = [
+        {"id": 1, "name": "fans_check", "vendor": "huawei", "model": "", "cmd": "display fans"},
+        {"id": 2, "name": "version", "vendor": "huawei", "model": "ce", "cmd": "display version"},
+        {"id": 3, "name": "version", "vendor": "cisco", "model": "nexus", "cmd": "show version"},
+    ]
+
+    def test_get_from_snapshot(self, app, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        publish_snapshot(path, self.items)
+        # 不传数据库会话, 读取只能来自快照
+        handler = ActionORMHandler(None, path)
+        assert [action.id for action in handler.get({"vendor": "huawei"})] == [1, 2]
+        assert [action.id for action in handler.get({"vendor": "huawei", "model": ""})] == [1]
+        assert [action.cmd for action in handler.get({"id": "3"})] == ["show version"]
+
+    def test_scan_from_snapshot(self, app, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        publish_snapshot(path, self.items)
+        handler = ActionORMHandler(None, path)
+        assert [item["id"] for item in handler.scan({}, after_id=1, limit=1)] == [2]
+        assert [item["id"] for item in handler.scan({"name": "version"}, after_id=2)] == [3]
+
+    def test_fallback_without_snapshot(self, tmp_path):
+        handler = ActionORMHandler(None, str(tmp_path / 'missing.snapshot'))
+        assert handler.snapshot is None
+
+
+def make_action(idx):
+    return {"id": idx, "name": "action_%d" % idx, "vendor": "huawei", "model": "", "cmd": "display %d" % idx}
+
+
+class TestActionJournal:
+
+    def make_path(self, tmp_path):
+        path = tmp_path / 'action.json'
+        path.write_text('[]')
+        return str(path)
+
+    def test_compact(self, tmp_path):
+        path = self.make_path(tmp_path)
+        handler = ActionJSONHandler(path, journal=True, compact_threshold=3, background_compact=False)
+        handler.add([make_action(1)])
+        handler.add([make_action(2)])
+        handler.delete({"name": "action_1"})
+        # 第三条记录触发合并, 日志只剩首行
+        with open(path) as f:
+            assert [item["id"] for item in json.load(f)] == [2]
+        with open(path + '.journal') as f:
+            assert len(f.readlines()) == 1
+        handler.add([make_action(3)])
+        other = ActionJSONHandler(path, journal=True)
+        assert [action.id for action in other.get()] == [2, 3]
+
+    def test_append_during_compact(self, tmp_path, monkeypatch):
+        path = self.make_path(tmp_path)
+        handler = ActionJSONHandler(path, journal=True)
+        other = ActionJSONHandler(path, journal=True)
+        handler.add([make_action(1)])
+        dump = json.dump
+
+        def dump_and_append(*args, **kwargs):
+            # 写新主文件期间, 另一个进程追加了记录
+            other.add([make_action(2)])
+            dump(*args, **kwargs)
+
+        monkeypatch.setattr(action_service.json, 'dump', dump_and_append)
+        handler.compact()
+        monkeypatch.undo()
+        with open(path) as f:
+            assert [item["id"] for item in json.load(f)] == [1]
+        assert [action.id for action in ActionJSONHandler(path, journal=True).get()] == [1, 2]
+
+    def test_crash_between_renames(self, tmp_path, monkeypatch):
+        path = self.make_path(tmp_path)
+        handler = ActionJSONHandler(path, journal=True)
+        other = ActionJSONHandler(path, journal=True)
+        handler.add([make_action(1)])
+        dump = json.dump
+        replace = os.replace
+
+        def dump_and_append(*args, **kwargs):
+            other.add([make_action(2)])
+            dump(*args, **kwargs)
+
+        def crash(src, dst):
+            replace(src, dst)
+            if dst == path:
+                raise KeyboardInterrupt
+
+        monkeypatch.setattr(action_service.json, 'dump', dump_and_append)
+        monkeypatch.setattr(action_service.os, 'replace', crash)
+        try:
+            handler.compact()
+        except KeyboardInterrupt:
+            pass
+        monkeypatch.undo()
+        # 主文件已替换, 合并期间追加的记录还在日志的临时文件中, 不能丢失
+        assert os.path.exists(path + '.journal.tmp')
+        assert [action.id for action in ActionJSONHandler(path, journal=True).get()] == [1, 2]
+        # 下次写入时补做rename
+        ActionJSONHandler(path, journal=True).add([make_action(3)])
+        assert not os.path.exists(path + '.journal.tmp')
+        assert [action.id for action in ActionJSONHandler(path, journal=True).get()] == [1, 2, 3]
+
+
+class TestInspectionSerialize:
+
+    def test_timestamp(self):
+        timestamp = datetime(2024, 1, 31, 23, 59, 59)
+        res = [{"action_id": 1, "validation_result": [{"power": True}]}]
+        rows = InspectionService.serialize("sn1", res, 1.5, timestamp=timestamp)
+        assert rows[0]["timestamp"] == timestamp
+        # 汇总按记录自身的巡检时间归属日期
+        assert {key[0] for key in aggregate(rows)} == {timestamp.date()}
+        assert InspectionService.serialize("sn1", res)[0]["timestamp"] is not None
+
+
+class TestInspectionAdd(BaseTest):
+
+    @staticmethod
+    def make_rows(sn):
+        return [{"sn": sn, "action_id": 1, "output": "FAN1 normal", "validation_result": '[{"fan": "normal"}]',
+                 "duration": 1.0}]
+
+    def test_failed_batch_rolls_back(self, app, monkeypatch):
+        handler = InspectionORMHandler(db.session, partitioned=False)
+        result_cache.drain()
+        result_cache.put((1, "digest", "hash"), [], [])
+
+        def fail(deltas):
+            raise Exception("rollup failed")
+
+        monkeypatch.setattr(handler, "save_rollup", fail)
+        with pytest.raises(Exception):
+            handler.add(self.make_rows("sn1"))
+        monkeypatch.undo()
+        # 失败批次的解析结果放回, 等待下一批写入
+        assert (1, "digest", "hash") in result_cache.drain()
+        handler.add(self.make_rows("sn2"))
+        # 失败批次已执行的语句不会随下一批提交
+        assert [row.sn for row in db.session.query(Inspection)] == ["sn2"]
+        assert db.session.query(InspectionRollup).count() == 2
+
+
+class TestInspectionExport(BaseTest):
+
+    def test_header_covers_all_keys(self, app):
+        handler = InspectionORMHandler(db.session, partitioned=False)
+        timestamp = datetime(2024, 1, 1, 8)
+        rows = [
+            ("sn1", '[{"power": "ok"}, {"fan": "ok"}]'),
+            ("sn2", '{"power": "ok", "temperature": 40}'),
+            ("sn2", '[{"power": "ok"}]'),
+        ]
+        for sn, validation_result in rows:
+            db.session.add(Inspection(sn=sn, action_id=1, validation_result=validation_result, timestamp=timestamp))
+        db.session.commit()
+        device = namedtuple("Device", ["sn", "hostname"])
+
+        class DeviceHandler:
+            @staticmethod
+            def get_by_sn(sns):
+                return [device(sn, "host-" + sn) for sn in sns]
+
+        content = "".join(handler.iter_export(DeviceHandler, datetime(2024, 1, 1), datetime(2024, 1, 2)))
+        reader = csv.DictReader(io.StringIO(content))
+        # 只出现在第二个条目和其他设备上的字段也要导出
+        assert reader.fieldnames == ["hostname", "power", "fan", "temperature"]
+        assert {row["hostname"]: row for row in reader}["host-sn1"]["fan"] == "ok"
@@ -0,0 +1,50 @@
+from app.services.channel import close_connection, send_batch, split_outputs
+
+
+class FakeChannel:
+
+    def __init__(self, prompt, replies):
+        self.prompt = prompt
+        self.replies = replies
+        self.written = []
+
+    def find_prompt(self):
+        return self.prompt
+
+    def write_channel(self, data):
+        self.written.append(data)
+        chunks = []
+        for cmd in data.splitlines():
+            chunks.append(f"{cmd}\r\n{self.replies[cmd]}\r\n{self.prompt}")
+        self.pending = list(chunks)
+
+    def read_channel(self):
+        return self.pending.pop(0) if self.pending else ""
+
+
+class TestChannel:
+
+    def test_split_outputs(self):
+        buffer = "display version\nVRP 8.1\n<sw1>display fans\nFAN1 normal\nFAN2 normal\n<sw1>"
+        assert split_outputs(buffer, "<sw1>", 2) == ["VRP 8.1", "FAN1 normal\nFAN2 normal"]
+
+    def test_send_batch(self):
+        channel = FakeChannel("<sw1>", {"display version": "VRP 8.1", "display fans": "FAN1 normal"})
+        outputs = send_batch(channel, ["display version", "display fans"], timeout=1)
+        assert channel.written == ["display version\ndisplay fans\n"]
+        assert outputs == ["VRP 8.1", "FAN1 normal"]
+
+    def test_close_connection(self):
+        class Conn:
+            closed = False
+
+            def disconnect(self):
+                self.closed = True
+
+        class Executor:
+            conn = Conn()
+
+        ssh = Executor()
+        assert close_connection(ssh)
+        assert ssh.conn.closed
+        assert not close_connection(object())
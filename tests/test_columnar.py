@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pytest
+
+from app.utils.columnar import infer_type, promote, update_schema, write_columns
+
+pyarrow = pytest.importorskip("pyarrow")
+
+
+class TestColumnar:
+
+    def test_infer_type(self):
+        assert infer_type([1, None, 2]) == "int"
+        assert infer_type([1, 2.5]) == "float"
+        assert infer_type([1, "a"]) == "str"
+        assert infer_type([None]) == "str"
+        assert promote(None, "bool") == "bool"
+
+    def test_update_schema(self):
+        schema = {"sn": "str"}
+        update_schema(schema, {"temperature": 40, "power": None})
+        update_schema(schema, {"temperature": 40.5, "power": True})
+        update_schema(schema, {"status": "normal"})
+        assert schema == {"sn": "str", "temperature": "float", "power": "bool", "status": "str"}
+
+    def test_parts_share_schema(self, tmp_path):
+        schema = {"sn": "str", "timestamp": "datetime", "temperature": "float", "status": "str"}
+        ts = datetime(2024, 1, 1)
+        first = write_columns(str(tmp_path / "part-0000"),
+                              {"sn": ["a"], "timestamp": [ts], "temperature": [40]}, schema)
+        second = write_columns(str(tmp_path / "part-0001"),
+                               {"sn": ["b"], "timestamp": [ts], "status": ["ok"]}, schema)
+        read = pyarrow.parquet.read_table if first.endswith(".parquet") else \
+            (lambda path: pyarrow.ipc.open_file(path).read_all())
+        assert read(first).schema == read(second).schema
+        assert read(first).column_names == ["sn", "timestamp", "temperature", "status"]
@@ -0,0 +1,52 @@
+import sqlite3
+import time
+
+import pytest
+
+from app.utils.db_pool import ConnectionPool
+
+
+class TestConnectionPool:
+
+    def test_reuse(self, tmp_path):
+        created = []
+
+        def creator():
+            created.append(sqlite3.connect(str(tmp_path / 'device.db'), check_same_thread=False))
+            return created[-1]
+
+        pool = ConnectionPool(creator, max_size=2)
+        with pool.connection() as conn:
+            conn.execute("create table devices (sn text primary key)")
+            conn.commit()
+        with pool.connection() as conn:
+            conn.execute("insert into devices values ('sn1')")
+            conn.commit()
+        assert len(created) == 1
+        pool.close_all()
+
+    def test_broken_connection_is_replaced(self, tmp_path):
+        pool = ConnectionPool(lambda: sqlite3.connect(str(tmp_path / 'device.db'), check_same_thread=False))
+        with pool.connection() as conn:
+            first = conn
+        first.close()
+        with pool.connection() as conn:
+            assert conn is not first
+            assert conn.execute("select 1").fetchone() == (1,)
+
+    def test_max_lifetime(self, tmp_path):
+        pool = ConnectionPool(
+            lambda: sqlite3.connect(str(tmp_path / 'device.db'), check_same_thread=False), max_lifetime=0.01)
+        with pool.connection() as conn:
+            first = conn
+        time.sleep(0.02)
+        with pool.connection() as conn:
+            assert conn is not first
+
+    def test_exhausted(self, tmp_path):
+        pool = ConnectionPool(
+            lambda: sqlite3.connect(str(tmp_path / 'device.db'), check_same_thread=False), max_size=1, timeout=0.01)
+        with pool.connection():
+            with pytest.raises(Exception):
+                with pool.connection():
+                    pass
@@ -0,0 +1,33 @@
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, declarative_base
+
+from app.utils.mode_dict import bulk_insert, column_names, to_mappings, to_models
+
+Base = declarative_base()
+
+
+class Record(Base):
+    __tablename__ = "mode_dict_record"
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    name = sa.Column(sa.String(32))
+    cmd = sa.Column(sa.String(32))
+
+
+class TestModeDict:
+
+    def test_to_models(self):
+        assert column_names(Record) == frozenset(["id", "name", "cmd"])
+        rows = [{"name": "a", "cmd": "show", "extra": 1}, {"name": "b"}]
+        models = to_models(Record, rows)
+        assert [(m.name, m.cmd) for m in models] == [("a", "show"), ("b", None)]
+        assert to_mappings(Record, rows) == [{"name": "a", "cmd": "show"}, {"name": "b"}]
+
+    def test_bulk_insert(self):
+        engine = sa.create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            rows = [{"name": "r%d" % i, "cmd": "show"} for i in range(5)] + [{"name": "x", "extra": 1}]
+            assert bulk_insert(session, Record, rows, chunk_size=2) == 6
+            session.commit()
+            assert session.query(Record).count() == 6
+            assert session.query(Record.cmd).filter(Record.name == "x").scalar() is None
@@ -0,0 +1,80 @@
+from app.services.parser import ActionSpec, ParserCache, ResultCache
+
+
+class TestResultCache:
+
+    action = ActionSpec(1, "fans_check", "regexp", r"(?P<fan>\S+)\s+(?P<status>\S+)")
+
+    def test_key_follows_validation(self):
+        class Handler:
+            @staticmethod
+            def fans_check(result):
+                return result
+
+        class ChangedHandler:
+            @staticmethod
+            def fans_check(result):
+                return [item for item in result if item["status"] != "normal"]
+
+        key = ResultCache.key(self.action, "hash", Handler)
+        assert key == ResultCache.key(self.action, "hash", Handler)
+        assert key != ResultCache.key(self.action, "hash", ChangedHandler)
+        # 没有校验方法时只取决于解析内容
+        assert ResultCache.key(self.action, "hash", object)[1] != key[1]
+
+    def test_restore(self):
+        cache = ResultCache()
+        key = ResultCache.key(self.action, "hash", object)
+        cache.put(key, [], [])
+        entries = cache.drain()
+        assert cache.drain() == {}
+        cache.restore(entries)
+        assert cache.drain() == entries
+
+
+class TestParserCache:
+
+    def make_action(self, action_id, content=r"(?P<fan>FAN\d)\s+(?P<status>\w+)"):
+        return ActionSpec(action_id, "fans_check", "regexp", content)
+
+    def test_parse_shapes(self):
+        output = "FAN1 normal\nFAN2 abnormal"
+        cache = ParserCache()
+        assert cache.parse(self.make_action(1), output) == [
+            {"fan": "FAN1", "status": "normal"}, {"fan": "FAN2", "status": "abnormal"}]
+        assert cache.parse(self.make_action(2, r"(FAN\d)\s+(\w+)"), output) == [
+            ["FAN1", "normal"], ["FAN2", "abnormal"]]
+        assert cache.parse(self.make_action(3, r"FAN\d"), output) == ["FAN1", "FAN2"]
+        assert cache.parse(self.make_action(4, None), output) == output
+
+    def test_lru_eviction(self):
+        cache = ParserCache(maxsize=2)
+        first = cache.get(self.make_action(1))
+        cache.get(self.make_action(2))
+        # 访问1之后, 最久未使用的是2
+        assert cache.get(self.make_action(1)) is first
+        cache.get(self.make_action(3))
+        assert cache.stats() == {"size": 2, "hits": 1, "misses": 3}
+        assert cache.get(self.make_action(1)) is first
+        cache.get(self.make_action(2))
+        assert cache.stats()["misses"] == 4
+
+    def test_digest_miss(self):
+        cache = ParserCache()
+        parser = cache.get(self.make_action(1))
+        # 同一个动作修改了解析内容, 摘要不同, 重新编译
+        changed = cache.get(self.make_action(1, r"(?P<fan>FAN\d)"))
+        assert changed is not parser
+        assert cache.stats()["misses"] == 2
+        assert cache.parse(self.make_action(1, r"(?P<fan>FAN\d)"), "FAN1 normal") == [{"fan": "FAN1"}]
+
+    def test_invalidate(self):
+        cache = ParserCache()
+        cache.get(self.make_action(1))
+        cache.get(self.make_action(2))
+        cache.invalidate([1])
+        assert cache.stats()["size"] == 1
+        cache.get(self.make_action(2))
+        assert cache.stats()["hits"] == 1
+        cache.invalidate()
+        assert cache.stats()["size"] == 0
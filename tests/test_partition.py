@@ -0,0 +1,88 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+from app.exts import db
+from app.models.inspection import InspectionOutput
+from app.services.partition import InspectionPartitions, _created
+
+from . import BaseTest
+
+
+def make_row(sn, timestamp, action_id=1):
+    return {"sn": sn, "action_id": action_id, "output_hash": "h", "validation_result": "[]",
+            "duration": 1.0, "timestamp": timestamp}
+
+
+class TestInspectionPartitions(BaseTest):
+
+    @pytest.fixture
+    def partitions(self, app):
+        partitions = InspectionPartitions(db.session, partitioned=True)
+        yield partitions
+        # 按月分表不在db.metadata中, BaseTest不会清理
+        for table in partitions.month_tables().values():
+            table.drop(db.session.connection())
+        db.session.commit()
+        _created.clear()
+
+    @staticmethod
+    def count(table):
+        return db.session.execute(select(func.count()).select_from(table)).scalar()
+
+    def test_insert_routing(self, partitions):
+        assert partitions.monthly
+        partitions.insert([make_row("sn1", datetime(2024, 1, 15)), make_row("sn1", datetime(2024, 2, 3)),
+                           make_row("sn2", datetime(2024, 2, 28, 23, 59))])
+        db.session.commit()
+        tables = partitions.month_tables()
+        assert sorted(tables) == [date(2024, 1, 1), date(2024, 2, 1)]
+        assert self.count(tables[date(2024, 1, 1)]) == 1
+        assert self.count(tables[date(2024, 2, 1)]) == 2
+
+    def test_tables_pruning(self, partitions):
+        partitions.insert([make_row("sn1", datetime(2024, month, 10)) for month in (1, 2, 3)])
+        db.session.commit()
+        names = [table.name for table in partitions.tables(datetime(2024, 2, 1), datetime(2024, 3, 1))]
+        assert names == ["inspection", "inspection_202402"]
+        names = [table.name for table in partitions.tables(None, datetime(2024, 2, 1))]
+        assert names == ["inspection", "inspection_202401"]
+        names = [table.name for table in partitions.tables(datetime(2024, 2, 15))]
+        assert names == ["inspection", "inspection_202402", "inspection_202403"]
+        assert len(partitions.tables()) == 4
+
+    def test_expire(self, partitions):
+        partitions.insert([make_row("sn1", datetime(2024, 1, 10)), make_row("sn1", datetime(2024, 1, 20)),
+                           make_row("sn1", datetime(2024, 2, 1)), make_row("sn1", datetime(2024, 2, 5)),
+                           make_row("sn1", datetime(2024, 2, 20))])
+        db.session.commit()
+        result = partitions.expire(datetime(2024, 2, 10))
+        # 一月整表删除, 二月只按行删除10日之前的两条
+        assert result == {"dropped": ["inspection_202401"], "deleted": 2}
+        assert sorted(partitions.month_tables()) == [date(2024, 2, 1)]
+        assert self.count(partitions.month_tables()[date(2024, 2, 1)]) == 1
+
+    def test_downsample(self, partitions):
+        partitions.insert([make_row("sn1", datetime(2024, 1, 10, hour)) for hour in (1, 2, 3)] +
+                          [make_row("sn2", datetime(2024, 1, 10, 1)), make_row("sn1", datetime(2024, 1, 11, 1)),
+                           make_row("sn1", datetime(2024, 1, 12, 1)), make_row("sn1", datetime(2024, 1, 12, 2))])
+        db.session.commit()
+        # 12日不在降采样范围内, 保留全部
+        assert partitions.downsample(datetime(2024, 1, 12)) == 2
+        table = partitions.month_tables()[date(2024, 1, 1)]
+        assert self.count(table) == 5
+        kept = db.session.execute(select(table.c.timestamp).where(table.c.sn == "sn1")
+                                  .order_by(table.c.timestamp)).scalars().all()
+        assert kept[0] == datetime(2024, 1, 10, 3)
+
+    def test_gc_outputs(self, partitions):
+        now = datetime.now()
+        old = now - timedelta(days=2)
+        for h, created_at in (("h", old), ("old", old), ("new", now)):
+            db.session.add(InspectionOutput(hash=h, codec="zlib", size=0, data=b"", created_at=created_at))
+        partitions.insert([make_row("sn1", now)])
+        db.session.commit()
+        # 被引用的和宽限期内的回显都保留, 后者可能被尚未提交的巡检记录引用
+        assert partitions.gc_outputs() == 1
+        assert sorted(h for h, in db.session.query(InspectionOutput.hash)) == ["h", "new"]
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from app.utils.query import build_select, build_upsert, build_where
+
+COLUMNS = {"sn": "devices.sn", "idc": "devices.idc", "port": "devices.port"}
+
+
+class TestQuery:
+
+    def test_where(self):
+        where, params = build_where(
+            {"sn": "A1", "idc": ["bj1", "bj2"], "port": {"gte": 1, "lt": 10}}, COLUMNS, "?")
+        assert where == "devices.sn = ? AND devices.idc IN (?, ?) AND devices.port >= ? AND devices.port < ?"
+        assert params == ["A1", "bj1", "bj2", 1, 10]
+
+    def test_reject_unknown(self):
+        with pytest.raises(Exception):
+            build_where({"sn; drop table devices": 1}, COLUMNS)
+        with pytest.raises(Exception):
+            build_select("devices", COLUMNS, projection=["password"])
+
+    def test_select(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("create table devices (sn text, idc text, port integer)")
+        conn.executemany("insert into devices values (?, ?, ?)",
+                         [("A1", "bj1", 1), ("A2", "bj2", 5), ("A3", "sh1", 20), ("A4", "bj1", None)])
+        sql, params = build_select("devices", COLUMNS, {"idc": ["bj1", "bj2"], "port": {"lte": 5}},
+                                   projection=["sn"], placeholder="?", order_by="sn")
+        assert conn.execute(sql, params).fetchall() == [("A1",), ("A2",)]
+        sql, params = build_select("devices", COLUMNS, {"port": None, "idc": []}, placeholder="?")
+        assert conn.execute(sql, params).fetchall() == []
+
+    def test_upsert(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("create table devices (sn text primary key, idc text, `row` text)")
+        columns = ("sn", "idc", "row")
+        sql = build_upsert("devices", columns, 2, dialect="sqlite", placeholder="?")
+        conn.execute(sql, ["A1", "bj1", "1", "A2", "bj2", "2"])
+        conn.execute(sql, ["A2", "sh1", "3", "A3", "sh2", "4"])
+        assert conn.execute("select * from devices order by sn").fetchall() == [
+            ("A1", "bj1", "1"), ("A2", "sh1", "3"), ("A3", "sh2", "4")]
+        assert build_upsert("devices", columns, 2, dialect="sqlite", placeholder="?") is sql
+        assert build_upsert("devices", columns, 1).endswith(
+            "on duplicate key update `idc` = values(`idc`), `row` = values(`row`)")
@@ -0,0 +1,22 @@
+from app.services.response_cache import ResponseCache, cached_stream
+
+
+class TestCachedStream:
+
+    def test_small_body_is_cached(self, app):
+        cache = ResponseCache(max_entry_bytes=10)
+        with app.test_request_context('/'):
+            resp = cached_stream('actions', 'small', lambda: iter([b'[', b'1', b']']), cache=cache)
+            assert resp.get_data() == b'[1]'
+            assert resp.headers['ETag']
+            cached_stream('actions', 'small', lambda: iter([b'[', b'1', b']']), cache=cache)
+        assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    def test_large_body_is_streamed(self, app):
+        cache = ResponseCache(max_entry_bytes=10)
+        with app.test_request_context('/'):
+            resp = cached_stream('actions', 'large', lambda: iter([b'x' * 6, b'y' * 6, b'z']), cache=cache)
+            assert resp.is_streamed
+            assert 'ETag' not in resp.headers
+            assert resp.get_data() == b'x' * 6 + b'y' * 6 + b'z'
+        assert cache.stats()['size'] == 0
@@ -0,0 +1,36 @@
+from datetime import date, datetime
+
+from app.utils.rollup import ALL_METRICS, aggregate, classify
+
+
+class TestRollup:
+
+    def test_classify(self):
+        assert classify(True) == "pass"
+        assert classify(" FAIL ") == "fail"
+        assert classify(3) == 3.0
+        assert classify("3") is None
+        assert classify(None) is None
+
+    def test_aggregate(self):
+        day = date(2024, 1, 1)
+        rows = [
+            {"action_id": 1, "idc": "bj1", "vendor": "huawei",
+             "validation_result": '[{"power": true, "temperature": 40}]'},
+            {"action_id": 1, "idc": "bj1", "vendor": "huawei",
+             "validation_result": {"power": "abnormal", "temperature": 55.5, "desc": "psu2"}},
+            {"action_id": 1, "idc": "bj1", "vendor": "huawei", "timestamp": datetime(2024, 1, 2, 8),
+             "validation_result": {"power": "ok"}},
+            {"action_id": 1, "validation_result": "not json"},
+        ]
+        result = aggregate(rows, day)
+        key = (day, "bj1", "huawei", 1)
+        assert result[key + ("power",)]["pass_count"] == 1
+        assert result[key + ("power",)]["fail_count"] == 1
+        temperature = result[key + ("temperature",)]
+        assert (temperature["value_count"], temperature["value_sum"]) == (2, 95.5)
+        assert (temperature["value_min"], temperature["value_max"]) == (40.0, 55.5)
+        assert result[key + (ALL_METRICS,)]["fail_count"] == 1
+        assert result[(date(2024, 1, 2), "bj1", "huawei", 1, ALL_METRICS)]["pass_count"] == 1
+        assert key + ("desc",) not in result
+        assert len(result) == 5
@@ -0,0 +1,36 @@
+import json
+from datetime import datetime
+from decimal import Decimal
+
+import sqlalchemy as sa
+from sqlalchemy.orm import declarative_base
+
+from app.utils.serializer import serializer_for
+
+Base = declarative_base()
+
+
+class Device(Base):
+    __tablename__ = "serializer_device"
+    sn = sa.Column(sa.String(32), primary_key=True)
+    price = sa.Column(sa.Numeric(10, 2))
+    created_at = sa.Column(sa.DateTime())
+
+
+class TestSerializer:
+
+    def test_to_dict(self):
+        serializer = serializer_for(Device)
+        assert serializer is serializer_for(Device)
+        row = Device(sn="A1", price=Decimal("1.50"), created_at=datetime(2024, 1, 2, 3, 4, 5))
+        assert serializer.to_dict(row) == {"sn": "A1", "price": 1.5, "created_at": "2024-01-02 03:04:05"}
+        assert serializer.to_dict(Device(sn="A2")) == {"sn": "A2", "price": None, "created_at": ""}
+
+    def test_stream(self):
+        serializer = serializer_for(Device)
+        rows = [Device(sn="设备%d" % i) for i in range(5)]
+        body = b"".join(serializer.iter_json(rows, batch_size=2))
+        assert [item["sn"] for item in json.loads(body)] == ["设备%d" % i for i in range(5)]
+        assert json.loads(b"".join(serializer.iter_json([]))) == []
+        lines = b"".join(serializer.iter_ndjson(rows, batch_size=2)).decode("utf-8").splitlines()
+        assert [json.loads(line)["sn"] for line in lines] == ["设备%d" % i for i in range(5)]
@@ -0,0 +1,70 @@
+import os
+
+from app.utils.snapshot import ActionSnapshot, publish_snapshot, snapshot_lock
+
+
+class TestActionSnapshot:
+
+    items = [
+        {"id": 1, "name": "fans_check", "vendor": "huawei", "model": "", "cmd": "display fans"},
+        {"id": 2, "name": "version", "vendor": "huawei", "model": "ce", "cmd": "display version"},
+        {"id": 3, "name": "version", "vendor": "cisco", "model": "nexus", "cmd": "show version"},
+    ]
+
+    def test_get(self, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        assert publish_snapshot(path, self.items) == 1
+        snapshot = ActionSnapshot(path)
+        assert len(snapshot) == 3
+        assert snapshot.get() == self.items
+        assert [item["id"] for item in snapshot.get({"vendor": "huawei"})] == [1, 2]
+        assert snapshot.get({"vendor": "huawei", "name": "version"}) == [self.items[1]]
+        assert snapshot.get({"vendor": "h3c"}) == []
+        assert snapshot.get({"vendor": "cisco", "model": ""}) == [self.items[2]]
+
+    def test_publish_new_generation(self, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        publish_snapshot(path, self.items)
+        snapshot = ActionSnapshot(path)
+        assert snapshot.generation == 1
+        publish_snapshot(path, self.items[:1])
+        assert snapshot.generation == 2
+        assert snapshot.get({"name": "version"}) == []
+
+    def test_publish_under_lock(self, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        with snapshot_lock(path):
+            # 持有锁时读取的代数与写入的代数一致
+            assert publish_snapshot(path, self.items, lock=False) == 1
+        assert publish_snapshot(path, self.items) == 2
+        assert os.path.exists(path + '.lock')
+
+    def test_scan(self, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        # 乱序发布, 快照内按id排序
+        publish_snapshot(path, list(reversed(self.items)))
+        snapshot = ActionSnapshot(path)
+        assert [item["id"] for item in snapshot.scan()] == [1, 2, 3]
+        assert [item["id"] for item in snapshot.scan(after_id=1, limit=1)] == [2]
+        assert [item["id"] for item in snapshot.scan({"vendor": "huawei"}, after_id=1)] == [2]
+        # 空值条件精确匹配
+        assert [item["id"] for item in snapshot.scan({"model": ""})] == [1]
+        assert list(snapshot.scan({"vendor": "huawei"}, after_id=2)) == []
+
+    def test_scan_is_lazy(self, tmp_path):
+        path = str(tmp_path / 'action.snapshot')
+        publish_snapshot(path, self.items)
+        snapshot = ActionSnapshot(path)
+        decoded = []
+        record = ActionSnapshot._record
+
+        def counting(state, idx):
+            decoded.append(idx)
+            return record(state, idx)
+
+        snapshot._record = counting
+        rows = snapshot.scan(after_id=2)
+        assert decoded == []
+        assert next(rows)["id"] == 3
+        # 二分定位只解码了O(log N)条记录
+        assert len(decoded) <= 3
@@ -13,3 +13,9 @@ class TestOption(BaseTest):
     def test_options(self, client):
         resp = client.get('/api/options')
         assert resp.status_code == 200
+
+    def test_options_etag(self, client):
+        resp = client.get('/api/options')
+        etag = resp.headers['ETag']
+        resp = client.get('/api/options', headers={'If-None-Match': etag})
+        assert resp.status_code == 304